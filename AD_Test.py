@@ -1,109 +1,211 @@
-import sys
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
 import socket
-from ldap3 import Server, Connection, ALL, NTLM, ALL_ATTRIBUTES, ALL_OPERATIONAL_ATTRIBUTES, AUTO_BIND_NO_TLS, SUBTREE
+import time
+from ldap3 import Server, Connection, NONE, SCHEMA, NTLM
+from ldap3.core.exceptions import LDAPException
 
 ####################################
 # written by:   Tim Smith
 # e-mail:       tismith@extremenetworks.com
-# date:         17th February 2022
-# version:      2.0.4
+# date:         18th October 2026
+# version:      2.1.0
 ####################################
+# Measures how fast the AD server answers the searches XIQ-AD-PPSK-Sync.py makes: DNS resolution,
+# bind, schema download and the paged group searches for every page size and group expansion
+# strategy below. The fastest settings are written to tuning_file, which the sync script loads.
+
+PATH = os.path.dirname(os.path.abspath(__file__))
 
 # Global Variables - ADD CORRECT VALUES
 server_name = "enter the server name/ IP"
 domain_name = "enter the domain name"
 user_name = "enter AD username"
 password = " enter AD password"
-distinguished_name = "Enter Distinguished Name string"
+#AD groups to probe (Distinguished Names)
+ad_groups = ["Enter Distinguished Name string"]
 
-#AD MaxPageSize 
-page = 1000
 #AD Filter to search
 AD_Filter = ""
+#Include members of nested groups
+AD_nested_groups = True
 
-def retrieveADUsers(ad_group):
-    #Building search base from domain_name
-    subdir_list = domain_name.split('.')
-    tdl = subdir_list[-1]
-    subdir_list = subdir_list[:-1]
-    if subdir_list:
-        SearchBase = 'DC=' + ',DC='.join(subdir_list) + ',DC=' + tdl
-    else:
-        SearchBase = 'DC=' + tdl
-    ad_result = []
-    #try:
-    server = Server(server_name, get_info=ALL)
-    conn = Connection(server, user='{}\\{}'.format(domain_name, user_name), password=password, authentication=NTLM, auto_bind=True)
-    conn.search(
-        search_base= SearchBase,
-        search_filter='(&(objectClass=user)(memberof:1.2.840.113556.1.4.1941:={}){})'.format(ad_group,AD_Filter),
-        search_scope=SUBTREE,
-        attributes = ['objectClass', 'userAccountControl', 'sAMAccountName', 'name', 'mail'],
-        paged_size = page)
-    ad_result.extend(conn.entries)
-    print(f"completed page of AD Users. Total Users collected is {len(ad_result)}")
-    cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-    while cookie:
-        conn.search(
-            search_base= SearchBase,
-            search_filter='(&(objectClass=user)(memberof:1.2.840.113556.1.4.1941:={}){})'.format(ad_group,AD_Filter),
-            search_scope=SUBTREE,
-            attributes = ['objectClass', 'userAccountControl', 'sAMAccountName', 'name', 'mail'],
-            paged_size = page,
-            paged_cookie = cookie)
-        ad_result.extend(conn.entries)
-        print(f"completed page of AD Users. Total Users collected is {len(ad_result)}")
-        cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+#Page sizes and group expansion strategies timed for every group ('member' doesn't page, it is timed once).
+#Every combination runs probe_repeats times and its fastest run counts, so a cold DC cache doesn't decide.
+page_sizes = [250, 500, 1000, 2000]
+strategies = ['matching_rule', 'member']
+probe_repeats = 2
+#Tuning report, the sync script reads it from its AD_tuning_file
+tuning_file = '{}/XIQ-AD-PPSK-ad-tuning.json'.format(PATH)
+
+
+def loadSyncModule():
+    spec = importlib.util.spec_from_file_location("xiq_ad_ppsk_sync", os.path.join(PATH, "XIQ-AD-PPSK-Sync.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def probeDNS():
+    # Seconds taken to resolve server_name, and the addresses it resolved to
+    started = time.perf_counter()
+    try:
+        addresses = sorted(set(info[4][0] for info in socket.getaddrinfo(server_name, 389, proto=socket.IPPROTO_TCP)))
+    except socket.gaierror:
+        print("cannot resolve hostname: ", server_name)
+        raise SystemExit
+    seconds = time.perf_counter() - started
+    print("The ip address for {} is {} ({:.3f}s)".format(server_name, ', '.join(addresses), seconds))
+    try:
+        print("DNS for {} is {}".format(addresses[0], socket.gethostbyaddr(addresses[0])[0]))
+    except OSError:
+        print("The DNS for {} is an Unknown Host".format(addresses[0]))
+    return seconds, addresses
+
+
+def probeBind(get_info):
+    # Seconds taken to bind, including the server info download asked for by get_info
+    started = time.perf_counter()
+    try:
+        conn = Connection(Server(server_name, get_info=get_info), user='{}\\{}'.format(domain_name, user_name), password=password, authentication=NTLM)
+        if not conn.bind():
+            print(f"Unable to bind to {server_name}: {conn.result.get('description')} {conn.result.get('message')}")
+            raise SystemExit
+    except LDAPException as e:
+        print(f"Unable to reach server {server_name}: {e}")
+        raise SystemExit
+    seconds = time.perf_counter() - started
     conn.unbind()
-    return ad_result
-    #except:
-    #    log_msg = f"Unable to reach server {server_name}"
-    #    logging.error(log_msg)
-    #    print(log_msg)
-    #    print("script exiting....")
-    #    raise SystemExit
-    
+    return seconds
+
+
+def probeSearch(sync, ad_group, strategy, page_size):
+    # Reads ad_group the way the sync does with these settings and returns its timings. The pool
+    # keeps its bound connections between probes, so bind time isn't counted here.
+    sync.page = page_size
+    sync.AD_group_expansion = strategy
+    sync.ad_expander = sync.GroupExpander()
+    sync.run_metrics = sync.RunMetrics()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        entries = sync.retrieveADUsers(ad_group)
+    seconds = time.perf_counter() - started
+    searches = sync.run_metrics.ldap_pages.values()
+    return {
+        "strategy": strategy,
+        "page": page_size if strategy == 'matching_rule' else None,
+        "seconds": seconds,
+        "entries": len(entries),
+        "searches": sum(pages["pages"] for pages in searches),
+        "max_search_seconds": max([pages["max_seconds"] for pages in searches], default=0.0),
+        "entries_per_second": len(entries) / seconds if seconds else 0.0
+    }
+
+
+def probeGroup(sync, ad_group, repeats):
+    # Fastest run of every strategy and page size for ad_group
+    results = []
+    for strategy in strategies:
+        for page_size in (page_sizes if strategy == 'matching_rule' else page_sizes[:1]):
+            runs = [probeSearch(sync, ad_group, strategy, page_size) for i in range(repeats)]
+            result = min(runs, key=lambda run: run["seconds"])
+            results.append(result)
+            page_text = result["page"] if result["page"] is not None else '-'
+            print(f"  {strategy:<14} {page_text:>6} {result['seconds']:9.3f} {result['searches']:>9} {result['max_search_seconds']:11.3f} "
+                  f"{result['entries']:>8} {result['entries_per_second']:10.0f}")
+    return results
+
+
+def recommend(groups):
+    # Fastest strategy and page size over all groups. A strategy that finds a different number of users
+    # than matching_rule (what the sync uses by default) in any group is not recommended. Returns None
+    # for the settings when nothing can be recommended.
+    totals = {}
+    mismatched = set()
+    for results in groups.values():
+        reference = [result["entries"] for result in results if result["strategy"] == 'matching_rule']
+        for result in results:
+            key = (result["strategy"], result["page"])
+            totals[key] = totals.get(key, 0.0) + result["seconds"]
+            if reference and result["entries"] != reference[0]:
+                mismatched.add(result["strategy"])
+    for strategy in sorted(mismatched):
+        print(f"Strategy {strategy} found a different number of users than matching_rule and is not recommended")
+    candidates = {key: seconds for key, seconds in totals.items() if key[0] not in mismatched}
+    if not candidates:
+        if not totals:
+            print("No AD groups were probed, nothing to recommend")
+        else:
+            print("The strategies and page sizes found different numbers of users, the directory may have changed during the probe. "
+                  "Nothing to recommend, run it again")
+        return None, totals
+    strategy, page_size = min(candidates, key=candidates.get)
+    paged = {key: seconds for key, seconds in totals.items() if key[0] == 'matching_rule'}
+    settings = {"AD_group_expansion": strategy}
+    if paged:
+        # the page size is also used by the incremental sync searches
+        settings["page"] = min(paged, key=paged.get)[1]
+    return settings, totals
+
 
 def main():
-    a = server_name.split('.')
-    if len(a) != 4:
-        try:
-            ip = socket.gethostbyname(server_name)
-        except socket.gaierror:
-            print ("cannot resolve hostname: ", server_name	)
-            raise SystemExit
-        print("The ip address for {} is {}".format(server_name, ip))	
+    global server_name, domain_name, user_name, password, ad_groups, AD_Filter, AD_nested_groups
+    parser = argparse.ArgumentParser(description="Measure AD search performance and write a tuning report for XIQ-AD-PPSK-Sync.py")
+    parser.add_argument('--sync-settings', action='store_true', help="probe the server and group_roles set in XIQ-AD-PPSK-Sync.py")
+    parser.add_argument('--repeats', type=int, default=probe_repeats, help="runs of every strategy and page size")
+    parser.add_argument('--output', default=tuning_file, help="tuning report file")
+    args = parser.parse_args()
+
+    sync = loadSyncModule()
+    if args.sync_settings:
+        server_name, domain_name, user_name, password = sync.server_name, sync.domain_name, sync.user_name, sync.password
+        ad_groups = list(dict.fromkeys(ad_group for ad_group, xiq_user_role in sync.group_roles))
+        AD_Filter, AD_nested_groups = sync.AD_Filter, sync.AD_nested_groups
     else:
-        ip = server_name
-        try:
-            dns = socket.gethostbyaddr(ip)
-            device = dns[0]
-            print("DNS for {} is {}".format(ip, device))
-        except:
-            print("The DNS for {} is an Unknown Host".format(ip))
-            device = ip
-        
-    ldap_users = {}
-    ldap_capture_success = True
-    ad_result = retrieveADUsers(distinguished_name)
-    #print(ad_result)
-    for ldap_entry in ad_result:
-        if str(ldap_entry.name) not in ldap_users:
-            try:
-                ldap_users[str(ldap_entry.name)] = {
-                    "userAccountControl": str(ldap_entry.userAccountControl),
-                    "email": str(ldap_entry.mail),
-                    "username": str(ldap_entry.sAMAccountName)
-                }
-            except:
-                log_msg = (f"Unexpected error: {sys.exc_info()[0]}")
-                print(log_msg)
-                # not having ppsk will break later line - for name, details in ldap_users.items():
-                ldap_capture_success = False
-                continue
-            
-    for name, details in ldap_users.items():
-        print(name, details)
+        sync.server_name, sync.domain_name, sync.user_name, sync.password = server_name, domain_name, user_name, password
+        sync.AD_Filter, sync.AD_nested_groups = AD_Filter, AD_nested_groups
+
+    dns_seconds, addresses = probeDNS()
+    bind_seconds = probeBind(NONE)
+    schema_seconds = max(probeBind(SCHEMA) - bind_seconds, 0.0)
+    print(f"Bind {bind_seconds:.3f}s, schema download {schema_seconds:.3f}s")
+
+    groups = {}
+    for ad_group in ad_groups:
+        print(ad_group)
+        print(f"  {'strategy':<14} {'page':>6} {'seconds':>9} {'searches':>9} {'max search':>11} {'users':>8} {'users/s':>10}")
+        groups[ad_group] = probeGroup(sync, ad_group, max(args.repeats, 1))
+    sync.closeConnections()
+
+    settings, totals = recommend(groups)
+    print("Total over all groups")
+    for (strategy, page_size), seconds in sorted(totals.items(), key=lambda item: item[1]):
+        print(f"  {strategy:<14} {page_size if page_size is not None else '-':>6} {seconds:9.3f}")
+    if settings is None:
+        print(f"No tuning report written to {args.output}")
+        raise SystemExit
+    report = {
+        "generated": time.time(),
+        "server": server_name,
+        "addresses": addresses,
+        "dns_seconds": dns_seconds,
+        "bind_seconds": bind_seconds,
+        "schema_seconds": schema_seconds,
+        "groups": groups,
+        "settings": settings
+    }
+    try:
+        sync.writeFileAtomic(args.output, json.dumps(report, indent=2))
+    except OSError as e:
+        print(f"Unable to write {args.output}: {e}")
+        raise SystemExit
+    print(f"Recommended settings {settings} written to {args.output}")
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
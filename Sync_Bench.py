@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from ldap3 import Server, Connection, NONE, SUBTREE, MOCK_SYNC
+####################################
+# Benchmarks for XIQ-AD-PPSK-Sync.py
+# Nothing in this script talks to AD or XIQ - all data is synthetic.
+####################################
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Number of users used for each point of the scaling curve
+bench_sizes = [1000, 5000, 10000, 20000, 40000]
+# The quadratic any() scans are only timed up to this size
+legacy_max_size = 5000
+# userAccountControl codes the any() scans treated as disabled
+legacy_disable_codes = ['514', '642', '66050', '66178']
+# Directory sizes used for the peak memory comparison
+memory_sizes = [1000, 10000]
+# Directory sizes used for the end to end run against the mock XIQ API and MOCK_SYNC directory
+run_sizes = [1000, 10000, 100000]
+# AD groups / XIQ user groups the synthetic users are spread over, the first one has a PCG
+bench_groups = 4
+# Directory sizes used for the group expansion comparison. MOCK_SYNC scans every entry for every search,
+# so the member strategy's batched DN lookups cost far more here than on a DC, compare the search counts.
+expansion_sizes = [1000]
+
+
+def loadSyncModule():
+    spec = importlib.util.spec_from_file_location("xiq_ad_ppsk_sync", os.path.join(PATH, "XIQ-AD-PPSK-Sync.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def buildUsers(sync, size):
+    # 90% of the AD users already exist in XIQ, 5% of the XIQ users have left AD and 2% of AD is disabled
+    ldap_users = {}
+    for i in range(size):
+        name = f"user{i:07d}"
+        ldap_users[name] = sync.LDAPUser("514" if i % 50 == 0 else "512", f"{name}@example.com", name, str(i % 4))
+    ppsk_users = []
+    for i in range(int(size * 0.95)):
+        if i % 10 == 0:
+            continue
+        name = f"user{i:07d}" if i % 20 else f"gone{i:07d}"
+        ppsk_users.append(sync.XIQUser(i, name, f"{name}@example.com", str(i % 4)))
+    return ldap_users, ppsk_users
+
+
+def legacyDiff(sync, ldap_users, ppsk_users):
+    # the any() scans main() used before the UserIndex
+    creates = []
+    disabled = []
+    for name, details in ldap_users.items():
+        if details.email == '[]':
+            continue
+        if not any(d.user_name == name for d in ppsk_users) and not any(d == details.userAccountControl for d in legacy_disable_codes):
+            creates.append(name)
+        elif any(d == details.userAccountControl for d in legacy_disable_codes):
+            disabled.append(name)
+    active = {name: details for name, details in ldap_users.items() if name not in disabled}
+    deletes = [x for x in ppsk_users if not any(d.email == x.email_address for d in active.values())]
+    return creates, deletes, disabled
+
+
+def indexedDiff(sync, ldap_users, ppsk_users):
+    user_index = sync.UserIndex()
+    for name, details in ldap_users.items():
+        user_index.addLDAPUser(name, details)
+    user_index.addPPSKUsers(ppsk_users)
+    creates, deletes, disabled, no_email, updates, moves = user_index.diff()
+    return creates, deletes, disabled
+
+
+def benchReconcile(sync):
+    print("Reconciliation scaling (seconds)")
+    print(f"{'users':>8} {'indexed':>10} {'us/user':>8} {'legacy':>10}")
+    for size in bench_sizes:
+        ldap_users, ppsk_users = buildUsers(sync, size)
+        start = time.perf_counter()
+        result = indexedDiff(sync, ldap_users, ppsk_users)
+        indexed = time.perf_counter() - start
+        legacy = "skipped"
+        if size <= legacy_max_size:
+            start = time.perf_counter()
+            legacy_result = legacyDiff(sync, ldap_users, ppsk_users)
+            legacy = f"{time.perf_counter() - start:10.3f}"
+            if [len(x) for x in legacy_result] != [len(x) for x in result]:
+                print(f"WARNING: indexed and legacy results differ for {size} users")
+        print(f"{size:>8} {indexed:10.3f} {indexed / size * 1e6:8.2f} {legacy:>10}")
+
+
+def mockDirectory(size, group_dn):
+    # ldap3 MOCK_SYNC connection holding size users that are members of group_dn
+    server = Server('bench-dc', get_info=NONE)
+    conn = Connection(server, user='CN=bench,DC=bench,DC=local', password='bench', client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry('CN=bench,DC=bench,DC=local', {'objectClass': 'user', 'userPassword': 'bench'})
+    for i in range(size):
+        name = f"user{i:07d}"
+        conn.strategy.add_entry(f'CN={name},OU=Users,DC=bench,DC=local', {
+            'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+            'name': name,
+            'sAMAccountName': name,
+            'mail': f"{name}@example.com",
+            'userAccountControl': '514' if i % 50 == 0 else '512',
+            'memberOf': group_dn
+        })
+    conn.bind()
+    return conn
+
+
+def xiqUserJSON(i):
+    # shape of an /endusers record as returned by XIQ
+    name = f"user{i:07d}"
+    return {"id": 900000000000 + i, "create_time": "2024-10-03T12:00:00.000Z", "update_time": "2024-10-03T12:00:00.000Z",
+            "org_id": 1, "user_group_id": 1234567, "user_group_name": "Students", "name": name, "user_name": name,
+            "organization": "", "visit_purpose": "", "description": "", "email_address": f"{name}@example.com",
+            "phone_number": "", "password": "", "expired_time": None, "status": "ACTIVE", "email_password_delivery": f"{name}@example.com",
+            "sms_password_delivery": "", "user_type": "PPSK"}
+
+
+def pagedEntries(conn, group_dn, on_page):
+    cookie = None
+    while True:
+        conn.search('DC=bench,DC=local', '(&(objectClass=user)(memberOf={}))'.format(group_dn), SUBTREE,
+                    attributes=['objectClass', 'userAccountControl', 'sAMAccountName', 'name', 'mail'], paged_size=1000, paged_cookie=cookie)
+        on_page(conn.entries)
+        cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+        if not cookie:
+            break
+
+
+def legacyCollect(sync, conn, group_dn, size):
+    # ldap3 Entry objects kept for the whole group, then copied into dicts, plus the full XIQ JSON
+    ad_result = []
+    pagedEntries(conn, group_dn, ad_result.extend)
+    ldap_users = {}
+    for ldap_entry in ad_result:
+        ldap_users[str(ldap_entry.name)] = {"userAccountControl": str(ldap_entry.userAccountControl), "email": str(ldap_entry.mail),
+                                            "username": str(ldap_entry.sAMAccountName), "xiq_role": "1234567"}
+    ppsk_users = [xiqUserJSON(i) for i in range(size)]
+    return ad_result, ldap_users, ppsk_users
+
+
+def compactCollect(sync, conn, group_dn, size):
+    # entries converted page by page into records, XIQ JSON converted as each page would arrive
+    user_index = sync.UserIndex()
+    pagedEntries(conn, group_dn, lambda entries: user_index.addLDAPEntries([sync.compactADEntry(entry) for entry in entries], "1234567"))
+    for start in range(0, size, 100):
+        page = [xiqUserJSON(i) for i in range(start, min(start + 100, size))]
+        user_index.addPPSKUsers([sync.XIQUser(user['id'], user['user_name'], user['email_address'], user['user_group_id']) for user in page])
+    return user_index
+
+
+def peakMemory(func, *args):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def benchMemory(sync):
+    print("Peak memory while collecting users (MB)")
+    print(f"{'users':>8} {'legacy kept':>12} {'legacy peak':>12} {'compact kept':>13} {'compact peak':>13}")
+    group_dn = 'CN=Students,OU=Groups,DC=bench,DC=local'
+    for size in memory_sizes:
+        conn = mockDirectory(size, group_dn)
+        legacy = peakMemory(legacyCollect, sync, conn, group_dn, size)
+        compact = peakMemory(compactCollect, sync, conn, group_dn, size)
+        print(f"{size:>8} {legacy[0] / 2**20:12.1f} {legacy[1] / 2**20:12.1f} {compact[0] / 2**20:13.1f} {compact[1] / 2**20:13.1f}")
+        conn.unbind()
+
+
+class MockXIQ:
+    """Local stand-in for the XIQ API endpoints used by the sync.
+
+    Every request sleeps for latency seconds. error_rate of the requests fail with a 500 and
+    rate_429 of them are answered with a 429 and a Retry-After header. End user pages larger than
+    max_limit are rejected with a 400.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_429=0.0, retry_after=0.1, max_limit=500):
+        self.latency = latency
+        self.max_limit = max_limit
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.users = {}
+        self.groups = {}
+        self.group_pages = {}
+        self.pcg_users = {}
+        self.next_id = 1
+        self.requests = 0
+        self.lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle_one(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, data, headers = mock.handle(method, self.path, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.handle_one('GET')
+
+            def do_POST(self):
+                self.handle_one('POST')
+
+            def do_PUT(self):
+                self.handle_one('PUT')
+
+            def do_DELETE(self):
+                self.handle_one('DELETE')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def newId(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def addUser(self, user_name, email, user_group_id):
+        user = {"id": self.newId(), "user_name": user_name, "name": user_name, "email_address": email, "user_group_id": user_group_id}
+        with self.lock:
+            self.users[user['id']] = user
+            self.groups.setdefault(str(user_group_id), {})[user['id']] = user
+            self.group_pages.pop(str(user_group_id), None)
+        return user
+
+    def deleteUser(self, user_id):
+        with self.lock:
+            user = self.users.pop(user_id, None)
+            if user:
+                self.groups[str(user['user_group_id'])].pop(user_id, None)
+                self.group_pages.pop(str(user['user_group_id']), None)
+        return user
+
+    def handle(self, method, path, body):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_429 and random.random() < self.rate_429:
+            return 429, {"error_message": "Too Many Requests"}, {"Retry-After": str(self.retry_after)}
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, {"error_message": "Internal Server Error"}, {}
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        if url.path == '/login':
+            return 200, {"access_token": "bench-token", "token_type": "Bearer", "expires_in": 86400}, {}
+        if url.path == '/endusers' and method == 'GET':
+            page = int(query.get('page', ['1'])[0])
+            limit = int(query.get('limit', ['10'])[0])
+            if limit > self.max_limit:
+                return 400, {"error_message": f"limit must be at most {self.max_limit}"}, {}
+            group = query.get('user_group_ids', [''])[0]
+            with self.lock:
+                if group not in self.group_pages:
+                    self.group_pages[group] = list(self.groups.get(group, {}).values())
+                users = self.group_pages[group]
+            total_pages = max(1, -(-len(users) // limit))
+            return 200, {"page": page, "count": min(limit, max(0, len(users) - (page - 1) * limit)), "total_pages": total_pages,
+                         "total_count": len(users), "data": users[(page - 1) * limit:page * limit]}, {}
+        if url.path == '/endusers' and method == 'POST':
+            return 200, self.addUser(body['user_name'], body['email_address'], body['user_group_id']), {}
+        match = re.match(r'^/endusers/(\d+)$', url.path)
+        if match and method == 'DELETE':
+            return (200, {}, {}) if self.deleteUser(int(match.group(1))) else (404, {"error_message": "not found"}, {})
+        if match and method == 'PUT':
+            with self.lock:
+                user = self.users.get(int(match.group(1)))
+                if user is None:
+                    return 404, {"error_message": "not found"}, {}
+                user.update({key: value for key, value in body.items() if key in ('name', 'user_name', 'email_address')})
+            return 200, user, {}
+        match = re.match(r'^/pcgs/key-based/network-policy-(\w+)/users$', url.path)
+        if match:
+            policy_id = match.group(1)
+            if method == 'GET':
+                with self.lock:
+                    pcg_users = list(self.pcg_users.get(policy_id, {}).values())
+                page = int(query.get('page', ['1'])[0])
+                limit = int(query.get('limit', ['10'])[0])
+                return 200, {"page": page, "total_pages": max(1, -(-len(pcg_users) // limit)), "total_count": len(pcg_users),
+                             "data": pcg_users[(page - 1) * limit:page * limit]}, {}
+            if method == 'POST':
+                for user in body['users']:
+                    pcg_user = dict(user, id=self.newId())
+                    with self.lock:
+                        self.pcg_users.setdefault(policy_id, {})[pcg_user['id']] = pcg_user
+                return 200, {}, {}
+            if method == 'DELETE':
+                with self.lock:
+                    for user_id in body['user_ids']:
+                        self.pcg_users.get(policy_id, {}).pop(user_id, None)
+                return 202, {}, {}
+        return 404, {"error_message": f"{method} {url.path} is not mocked"}, {}
+
+
+def seedRun(sync, size, mock):
+    # AD: size users spread over bench_groups groups, 2% disabled and 1% without an email.
+    # XIQ: 90% of the AD users already exist, plus 5% that have left AD. The first group has a PCG.
+    server = Server('bench-dc', get_info=NONE)
+    conn = Connection(server, user='CN=bench,DC=bench,DC=local', password='bench', client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry('CN=bench,DC=bench,DC=local', {'objectClass': 'user', 'userPassword': 'bench'})
+    group_roles = [(f'CN=Group{g},OU=Groups,DC=bench,DC=local', str(1000 + g)) for g in range(bench_groups)]
+    for i in range(size):
+        name = f"user{i:07d}"
+        ad_group, xiq_group = group_roles[i % bench_groups]
+        attributes = {'objectClass': ['top', 'person', 'organizationalPerson', 'user'], 'name': name, 'sAMAccountName': name,
+                      'userAccountControl': '514' if i % 50 == 1 else '512', 'memberOf': ad_group}
+        if i % 100 != 2:
+            attributes['mail'] = f"{name}@example.com"
+        conn.strategy.add_entry(f'CN={name},OU=Users,DC=bench,DC=local', attributes)
+        if i % 10:
+            user = mock.addUser(name, f"{name}@example.com", xiq_group)
+            if xiq_group == group_roles[0][1]:
+                pcg_user = {"id": mock.newId(), "name": name, "email": user['email_address'], "user_group_name": "Bench Group 0"}
+                mock.pcg_users.setdefault('2000', {})[pcg_user['id']] = pcg_user
+    for i in range(size // 20):
+        name = f"gone{i:07d}"
+        mock.addUser(name, f"{name}@example.com", group_roles[i % bench_groups][1])
+    sync.domain_name = 'bench.local'
+    sync.AD_nested_groups = False
+    sync.group_roles = group_roles
+    sync.PCG_Enable = True
+    sync.PCG_Maping = {group_roles[0][1]: {"UserGroupName": "Bench Group 0", "policy_id": "2000", "policy_name": "Bench Policy"}}
+    sync.URL = mock.url
+
+    def connect(host):
+        # auto_bind does not bind MOCK_SYNC connections
+        mock_conn = Connection(server, user='CN=bench,DC=bench,DC=local', password='bench', client_strategy=MOCK_SYNC)
+        mock_conn.bind()
+        return mock_conn
+    sync.getADPool().connect = connect
+
+
+class PhaseRecorder:
+    """Splits a main() run into phases by wrapping the sync functions that start each phase."""
+
+    def __init__(self, sync, mock, trace_memory):
+        self.mock = mock
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.current = None
+        self.lock = threading.Lock()
+        self.wrapPhase(sync, 'main', 'collect')
+        self.wrapPhase(sync, 'collectPCGUsers', 'pcg read')
+        # the write lanes create and delete at the same time
+        self.wrapPhase(sync, 'applyOperations', 'write')
+
+    def wrapPhase(self, owner, attribute, phase):
+        func = getattr(owner, attribute)
+
+        def wrapper(*args, **kwargs):
+            self.start(phase)
+            return func(*args, **kwargs)
+        setattr(owner, attribute, wrapper)
+
+    def start(self, phase):
+        with self.lock:
+            if self.current and self.current[0] == phase:
+                return
+            self.finish()
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+            self.current = (phase, time.perf_counter(), self.mock.requests)
+
+    def finish(self):
+        if self.current is None:
+            return
+        phase, started, requests = self.current
+        peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+        self.phases.append((phase, time.perf_counter() - started, self.mock.requests - requests, peak))
+        self.current = None
+
+
+def benchRun(sizes, latency, error_rate, rate_429, rate_limit, trace_memory):
+    print(f"End to end run - XIQ latency {latency * 1000:.0f}ms, error rate {error_rate:.1%}, 429 rate {rate_429:.1%}")
+    print(f"{'users':>8} {'phase':<10} {'seconds':>9} {'requests':>9} {'req/s':>9} {'peak MB':>9}")
+    for size in sizes:
+        sync = loadSyncModule()
+        sync.XIQ_rate_limit = rate_limit
+        sync.rate_limiter = sync.TokenBucket(rate_limit, sync.XIQ_rate_burst)
+        sync.XIQ_backoff_base = 0.05
+        mock = MockXIQ(latency, error_rate, rate_429)
+        seedRun(sync, size, mock)
+        recorder = PhaseRecorder(sync, mock, trace_memory)
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                sync.main()
+        except SystemExit:
+            print(output.getvalue()[-2000:])
+            raise
+        finally:
+            recorder.finish()
+            total = time.perf_counter() - started
+            if trace_memory:
+                tracemalloc.stop()
+            mock.close()
+            sync.closeConnections()
+        for phase, seconds, requests, peak in recorder.phases + [('total', total, mock.requests, max(p[3] for p in recorder.phases))]:
+            print(f"{size:>8} {phase:<10} {seconds:9.2f} {requests:>9} {requests / seconds if seconds else 0:9.0f} {peak / 2**20:9.1f}")
+        for lane, applied in sync.run_metrics.laneLatency().items():
+            print(f"{size:>8} {lane + ' lane':<10} {applied['applied']:>9} changes, detection to applied {applied['p50']:.2f}s median {applied['max']:.2f}s max")
+
+
+def expansionDirectory(size):
+    # bench_groups mapped groups, each holding two nested groups that hold the users. Every tenth user
+    # is also in the next mapped group. Users carry memberOf for the groups they are directly in.
+    server = Server('bench-dc', get_info=NONE)
+    conn = Connection(server, user='CN=bench,DC=bench,DC=local', password='bench', client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry('CN=bench,DC=bench,DC=local', {'objectClass': 'user', 'userPassword': 'bench'})
+    groups = [f'CN=Group{g},OU=Groups,DC=bench,DC=local' for g in range(bench_groups)]
+    nested = [[f'CN=Group{g}-{n},OU=Groups,DC=bench,DC=local' for n in range(2)] for g in range(bench_groups)]
+    members = {dn: [] for dn in groups + [dn for pair in nested for dn in pair]}
+    for i in range(size):
+        dn = f'CN=user{i:07d},OU=Users,DC=bench,DC=local'
+        g = i % bench_groups
+        member_of = [nested[g][i % 2]]
+        if i % 10 == 0:
+            member_of.append(groups[(g + 1) % bench_groups])
+        for group_dn in member_of:
+            members[group_dn].append(dn)
+        name = f"user{i:07d}"
+        conn.strategy.add_entry(dn, {'objectClass': ['top', 'person', 'organizationalPerson', 'user'], 'distinguishedName': dn,
+                                     'name': name, 'sAMAccountName': name, 'mail': f"{name}@example.com",
+                                     'userAccountControl': '512', 'memberOf': member_of})
+    for g, group_dn in enumerate(groups):
+        members[group_dn].extend(nested[g])
+    for group_dn, group_members in members.items():
+        conn.strategy.add_entry(group_dn, {'objectClass': ['top', 'group'], 'distinguishedName': group_dn, 'member': group_members})
+    return server, groups
+
+
+def benchExpansion(sync, sizes):
+    # matching_rule can only be compared on direct members, MOCK_SYNC has no LDAP_MATCHING_RULE_IN_CHAIN
+    print("Group expansion strategies over MOCK_SYNC")
+    print(f"{'users':>8} {'strategy':<14} {'nested':>6} {'seconds':>9} {'searches':>9} {'users found':>12}")
+    for size in sizes:
+        server, groups = expansionDirectory(size)
+        for strategy, nested in [('matching_rule', False), ('member', False), ('member', True)]:
+            sync = loadSyncModule()
+            sync.domain_name = 'bench.local'
+            sync.AD_group_expansion = strategy
+            sync.AD_nested_groups = nested
+            sync.ad_expander = sync.GroupExpander()
+            searches = [0]
+
+            def connect(host):
+                conn = Connection(server, user='CN=bench,DC=bench,DC=local', password='bench', client_strategy=MOCK_SYNC)
+                conn.bind()
+                search = conn.search
+
+                def counted(*args, **kwargs):
+                    searches[0] += 1
+                    return search(*args, **kwargs)
+                conn.search = counted
+                return conn
+            sync.getADPool().connect = connect
+            found = 0
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for group_dn in groups:
+                    found += len(sync.retrieveADUsers(group_dn))
+            seconds = time.perf_counter() - started
+            sync.closeConnections()
+            print(f"{size:>8} {strategy:<14} {str(nested):>6} {seconds:9.2f} {searches[0]:>9} {found:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for XIQ-AD-PPSK-Sync.py")
+    parser.add_argument('benchmarks', nargs='*', choices=['reconcile', 'memory', 'run', 'expansion'], default=['reconcile', 'memory'])
+    parser.add_argument('--sizes', help="comma separated directory sizes for the run and expansion benchmarks")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every mock XIQ request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of mock XIQ requests failing with a 500")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of mock XIQ requests answered with a 429")
+    parser.add_argument('--rate-limit', type=float, default=0, help="XIQ_rate_limit used by the sync (0 disables it)")
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory during the run benchmark (faster)")
+    args = parser.parse_args()
+    sync = loadSyncModule()
+    if 'reconcile' in args.benchmarks:
+        benchReconcile(sync)
+        print()
+    if 'memory' in args.benchmarks:
+        benchMemory(sync)
+        print()
+    if 'run' in args.benchmarks:
+        sizes = [int(size) for size in args.sizes.split(',')] if args.sizes else run_sizes
+        benchRun(sizes, args.latency, args.error_rate, args.rate_429, args.rate_limit, not args.no_memory)
+        print()
+    if 'expansion' in args.benchmarks:
+        sizes = [int(size) for size in args.sizes.split(',')] if args.sizes else expansion_sizes
+        benchExpansion(sync, sizes)
+
+
+if __name__ == '__main__':
+    main()
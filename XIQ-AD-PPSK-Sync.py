@@ -1,10 +1,40 @@
 #!/usr/bin/env python3
+import argparse
+import atexit
+import base64
+import hashlib
 import json
 import requests
 import sys
 import os
 import logging
-from ldap3 import Server, Connection, ALL, NTLM, SUBTREE
+import logging.handlers
+import multiprocessing
+import queue
+import re
+import sqlite3
+from collections import namedtuple
+import random
+import signal
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # no file locking on Windows, overlapping runs have to be avoided by the scheduler
+    fcntl = None
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    # SRV discovery of the domain controllers (AD_discover_dcs) needs dnspython
+    dns = None
+from ldap3 import Server, Connection, NONE, SCHEMA, NTLM, BASE, SUBTREE
+from ldap3.core.exceptions import LDAPException, LDAPCommunicationError
+from ldap3.utils.conv import escape_filter_chars
 ####################################
 # written by:   Tim Smith
 # e-mail:       tismith@extremenetworks.com
@@ -23,6 +53,34 @@ password = " enter AD password"
 page = 1000
 #AD Filter to search
 AD_Filter = ""
+#Leave disabled accounts out of the AD searches (userAccountControl ACCOUNTDISABLE bit, checked on the DC)
+AD_exclude_disabled = False
+#Include members of nested groups (LDAP_MATCHING_RULE_IN_CHAIN). When False only direct members are read
+AD_nested_groups = True
+#How group members are found: 'matching_rule' searches the domain for users by memberOf, 'member' reads the
+#member attribute of the groups (ranged for large groups) and follows nested groups in the script
+AD_group_expansion = 'matching_rule'
+#Other domain controllers of the domain, used with server_name. With AD_discover_dcs the DCs are looked up in
+#DNS instead (_ldap._tcp.dc._msdcs SRV records of domain_name, needs dnspython) and the list is the fallback
+AD_servers = []
+AD_discover_dcs = False
+#Seconds to wait for a DC to accept a connection, and seconds before the DCs are probed again and a failed DC
+#is tried again
+AD_connect_timeout = 10
+AD_dc_retry = 300
+#Number of bound AD connections shared by the group searches
+AD_connections = 4
+#Download the AD schema when binding (not needed by the sync)
+AD_schema_info = False
+#Split the full read of a group into AD_shards sAMAccountName ranges searched at the same time over separate
+#connections (keep AD_connections at least as high). The ranges are rebalanced from the users found by the
+#last run. 1 reads every group with a single paged search.
+AD_shards = 1
+#Times a group search is restarted after losing the AD connection
+AD_reconnect_attempts = 3
+#Only read AD users changed since the last run (uSNChanged), with a full resync every AD_full_resync_hours
+AD_incremental = False
+AD_full_resync_hours = 24
 
 #XIQ_username = "enter your ExtremeCloudIQ Username"
 #XIQ_password = "enter your ExtremeCLoudIQ password"
@@ -38,6 +96,55 @@ group_roles = [
 
 PCG_Enable = False
 
+# Daemon mode (--daemon) - seconds between the start of two sync cycles and the random delay added to it
+sync_interval = 900
+sync_jitter = 30
+
+# Multi-tenant mode (--tenants FILE) - tenants synced at the same time, each in its own process, and the
+# XIQ requests allowed in flight per tenant and over all tenants. A tenant still running after
+# tenant_timeout seconds is stopped, and killed if its requests in flight don't finish within
+# tenant_stop_timeout seconds.
+tenant_workers = 4
+tenant_api_calls = 8
+global_api_calls = 24
+tenant_timeout = 3600
+tenant_stop_timeout = 60
+
+# Number of AD groups and XIQ user groups collected in parallel
+collect_workers = 8
+# The writes run in priority lanes at the same time so removals aren't queued behind a large create
+# backlog: 'remove' (users that left AD), 'modify' (updates and group moves) and 'create'. Each lane has
+# its own workers and XIQ requests per second (0 leaves it to XIQ_rate_limit alone). When XIQ_rate_limit
+# runs short its requests go to 'remove' first, then 'modify', then 'create'.
+write_lanes = {
+    # lane: (workers, requests per second)
+    'remove': (8, 0),
+    'modify': (4, 0),
+    'create': (8, 0)
+}
+# Number of users sent in each PCG add/delete call
+pcg_batch_size = 100
+
+# Keep the XIQ end users and PCG users in a local SQLite store and only read them back from XIQ
+# every XIQ_verify_hours, or when the user count of a group no longer matches the store
+XIQ_state_store = False
+XIQ_verify_hours = 24
+
+# XIQ API client - retries on 429/5xx with exponential backoff and a client side rate limit
+XIQ_timeout = 60
+XIQ_max_retries = 5
+XIQ_backoff_base = 1
+XIQ_backoff_max = 60
+# requests per second and burst size allowed by the client side token bucket (0 disables)
+XIQ_rate_limit = 10
+XIQ_rate_burst = 20
+# end users requested per page, lowered automatically when XIQ rejects or caps it
+XIQ_page_size = 1000
+# pages of a user group fetched at the same time once the page count is known
+XIQ_page_workers = 4
+# PCG users requested per page, lowered automatically when XIQ rejects it
+XIQ_pcg_page_size = 1000
+
 PCG_Maping = {
     "XIQ User Group ID" : {
         "UserGroupName": "XIQ User Group Name",
@@ -51,67 +158,1146 @@ PCG_Maping = {
 #-------------------------
 # logging
 PATH = os.path.dirname(os.path.abspath(__file__))
-logging.basicConfig(
-    filename='{}/XIQ-AD-PPSK-sync.log'.format(PATH),
-    filemode='a',
-    level=os.environ.get("LOGLEVEL", "INFO"),
-    format= '%(asctime)s: %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
-)
-# userAccountControl codes used for disabled accounts
-ldap_disable_codes = ['514','642','66050','66178']
+log_file = '{}/XIQ-AD-PPSK-sync.log'.format(PATH)
+# The log is rotated at log_max_bytes (0 never rotates) keeping log_backups old files. log_json writes one
+# JSON object per record instead of text lines
+log_max_bytes = 50 * 1024 * 1024
+log_backups = 5
+log_json = False
+# Seconds between the progress lines printed while users are collected, created and deleted
+progress_interval = 5
+AD_state_file = '{}/XIQ-AD-PPSK-ad-state.json'.format(PATH)
+AD_shard_file = '{}/XIQ-AD-PPSK-ad-shards.json'.format(PATH)
+# Tuning report written by AD_Test.py ('' disables). When it exists its page size and group expansion
+# strategy replace the values set above.
+AD_tuning_file = '{}/XIQ-AD-PPSK-ad-tuning.json'.format(PATH)
+XIQ_state_db = '{}/XIQ-AD-PPSK-state.db'.format(PATH)
+# Run report with phase timings, HTTP latency and LDAP page timings ('' disables). The Prometheus file is
+# meant for the node_exporter textfile collector, e.g. /var/lib/node_exporter/textfile/xiq_ad_sync.prom
+metrics_json_file = '{}/XIQ-AD-PPSK-metrics.json'.format(PATH)
+metrics_prom_file = ''
+lock_file = '{}/XIQ-AD-PPSK-sync.lock'.format(PATH)
+tenants_report_file = '{}/XIQ-AD-PPSK-tenants.json'.format(PATH)
+# Access token from XIQ_username/XIQ_password logins, reused until XIQ_token_refresh seconds before it
+# expires ('' keeps it in memory only)
+XIQ_token_file = '{}/XIQ-AD-PPSK-token.json'.format(PATH)
+XIQ_token_refresh = 300
+# ACCOUNTDISABLE flag of userAccountControl
+UF_ACCOUNTDISABLE = 0x2
 
 URL = "https://api.extremecloudiq.com"
 headers = {"Accept": "application/json", "Content-Type": "application/json"}
 
 
-def retrieveADUsers(ad_group):
+class JSONFormatter(logging.Formatter):
+    """One JSON object per log record, with any extra= fields of the record."""
+
+    standard = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        data = {"time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), "level": record.levelname, "logger": record.name,
+                "thread": record.threadName, "message": record.getMessage()}
+        data.update((key, value) for key, value in vars(record).items() if key not in self.standard)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+log_listener = None
+
+
+def setupLogging(path):
+    # Log records are put on a queue by the logging threads and written to path by one listener
+    # thread, so the sync threads never wait on the disk
+    global log_listener
+    stopLogging()
+    if log_max_bytes:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=log_max_bytes, backupCount=log_backups)
+    else:
+        handler = logging.FileHandler(path)
+    if log_json:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s: %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+        old_handler.close()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.environ.get("LOGLEVEL", "INFO"))
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+
+
+def stopLogging():
+    # Writes the queued records and closes the log file
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+
+class ProgressReporter:
+    """Counts progress per label and prints it at most every progress_interval seconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.totals = {}
+            self.last = time.monotonic()
+
+    def start(self, label, total=None):
+        with self.lock:
+            self.counts[label] = 0
+            self.totals[label] = total
+
+    def line(self, label):
+        total = self.totals.get(label)
+        return f"{label}: {self.counts[label]}" + (f" of {total}" if total is not None else "")
+
+    def advance(self, label, count=1):
+        with self.lock:
+            self.counts[label] = self.counts.get(label, 0) + count
+            now = time.monotonic()
+            if now - self.last < progress_interval:
+                return
+            self.last = now
+            line = ", ".join(self.line(label) for label in self.counts)
+        print(line)
+
+    def finish(self, label, report=True):
+        with self.lock:
+            if label not in self.counts:
+                return
+            line = self.line(label) + " done"
+            del self.counts[label]
+            self.totals.pop(label, None)
+        if report:
+            print(line)
+
+
+setupLogging(log_file)
+atexit.register(stopLogging)
+progress = ProgressReporter()
+
+# status codes that are retried by xiqRequest. Only a 429 is retried for a POST: after a 5xx or a
+# lost response XIQ may already have made the change, and sending it again would fail as a duplicate.
+retry_status_codes = [429, 500, 502, 503, 504]
+idempotent_methods = ['GET', 'PUT', 'DELETE']
+
+
+class TokenBucket:
+    """Client side rate limiter shared by every thread calling the XIQ API."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        # callers waiting for a token per priority
+        self.waiting = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, priority=0):
+        # A caller only takes a token when no caller with a higher priority (lower number) is waiting
+        if not self.rate:
+            return
+        with self.lock:
+            self.waiting[priority] = self.waiting.get(priority, 0) + 1
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    first = not any(count for level, count in self.waiting.items() if level < priority)
+                    if first and now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0 if first else 1 / self.rate)
+                time.sleep(wait)
+        finally:
+            with self.lock:
+                self.waiting[priority] -= 1
+
+    def pause(self, seconds):
+        # holds every caller back, used when XIQ answers with a 429
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(sum(workers for workers, rate in write_lanes.values()), 10)))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(sum(workers for workers, rate in write_lanes.values()), 10)))
+rate_limiter = TokenBucket(XIQ_rate_limit, XIQ_rate_burst)
+api_stats = {}
+api_stats_lock = threading.Lock()
+# Caps on the XIQ requests in flight, set for each tenant process by the multi-tenant runner
+api_slots = None
+global_api_slots = None
+# global slots this tenant process holds, so the runner can give them back when the process crashes
+global_api_held = None
+# set when the runner stops this tenant process
+tenant_stopping = threading.Event()
+# end user page size XIQ accepted, see retrievePPSKUsers()
+ppsk_page_size = None
+# PCG user page size XIQ accepted, see retrievePCGUsers()
+pcg_page_size = None
+# write lane of the thread (current_lane.lane), see applyOperations()
+current_lane = threading.local()
+
+
+def countApiCall(endpoint, counter):
+    with api_stats_lock:
+        stats = api_stats.setdefault(endpoint, {"requests": 0, "retries": 0, "failures": 0})
+        stats[counter] += 1
+
+
+def retryDelay(attempt, response=None):
+    # honours Retry-After (seconds or HTTP date), otherwise exponential backoff with full jitter
+    if response is not None and response.headers.get("Retry-After"):
+        retry_after = response.headers["Retry-After"]
+        try:
+            return min(float(retry_after), XIQ_backoff_max)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), XIQ_backoff_max)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(XIQ_backoff_max, XIQ_backoff_base * 2 ** attempt))
+
+
+def countHeldSlots(change):
+    with global_api_held.get_lock():
+        global_api_held.value += change
+
+
+def acquireGlobalSlot():
+    # The held count is raised after the slot is taken and lowered before it is given back, so a process
+    # killed in between makes the runner give back one slot too few, never one too many. A stopped
+    # tenant gives up waiting.
+    while not global_api_slots.acquire(timeout=1):
+        if tenant_stopping.is_set():
+            raise SystemExit
+    try:
+        countHeldSlots(1)
+    except BaseException:
+        global_api_slots.release()
+        raise
+
+
+def releaseGlobalSlot():
+    countHeldSlots(-1)
+    global_api_slots.release()
+
+
+def stopTenant(signum, frame):
+    # SIGTERM from the runner: requests not sent yet are dropped and the requests in flight give their
+    # slots back in apiSlot() as they finish
+    tenant_stopping.set()
+    raise SystemExit
+
+
+@contextmanager
+def apiSlot():
+    # Holds a tenant and a global slot (when the multi-tenant runner set them) while a request is sent
+    if tenant_stopping.is_set():
+        raise SystemExit
+    if api_slots is not None:
+        api_slots.acquire()
+    try:
+        if global_api_slots is not None:
+            acquireGlobalSlot()
+        try:
+            yield
+        finally:
+            if global_api_slots is not None:
+                releaseGlobalSlot()
+    finally:
+        if api_slots is not None:
+            api_slots.release()
+
+
+def xiqRequest(method, url, endpoint, handled_status=None, **kwargs):
+    # Sends the request over the shared session. Connection errors and retry_status_codes are
+    # retried up to XIQ_max_retries times, anything else is returned to the caller to handle. A POST
+    # (other than the login) is only retried on a 429 or a ConnectTimeout, when XIQ never got it.
+    # A 401 makes the token manager log in again (once per request) and the request is sent again.
+    # handled_status is an error status the caller expects and handles, it isn't counted as a failure.
+    attempt = 0
+    reauthenticated = False
+    safe_to_resend = method in idempotent_methods or endpoint == "POST /login"
+    while True:
+        manage_token = token_manager is not None and endpoint != "POST /login"
+        if manage_token:
+            token_manager.ensureFresh()
+        authorization = headers.get("Authorization")
+        lane = getattr(current_lane, 'lane', None)
+        if lane is not None:
+            lane.limiter.acquire()
+        rate_limiter.acquire(lane.priority if lane is not None else 0)
+        countApiCall(endpoint, "requests")
+        started = time.perf_counter()
+        try:
+            with apiSlot():
+                response = session.request(method, url, headers=headers, timeout=XIQ_timeout, **kwargs)
+            run_metrics.observeHttp(endpoint, time.perf_counter() - started)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= XIQ_max_retries or not (safe_to_resend or isinstance(e, requests.exceptions.ConnectTimeout)):
+                countApiCall(endpoint, "failures")
+                raise
+            delay = retryDelay(attempt)
+            logging.warning(f"{endpoint} failed with {e.__class__.__name__}, retrying in {delay:.1f}s")
+        else:
+            if response.status_code == 401 and manage_token and not reauthenticated:
+                logging.warning(f"{endpoint} returned HTTP 401, logging in again")
+                reauthenticated = True
+                token_manager.refresh(authorization)
+                continue
+            if response.status_code not in retry_status_codes or not (safe_to_resend or response.status_code == 429):
+                if response.status_code >= 400 and response.status_code != handled_status:
+                    countApiCall(endpoint, "failures")
+                return response
+            if attempt >= XIQ_max_retries:
+                countApiCall(endpoint, "failures")
+                return response
+            delay = retryDelay(attempt, response)
+            if response.status_code == 429:
+                rate_limiter.pause(delay)
+            logging.warning(f"{endpoint} returned HTTP {response.status_code}, retrying in {delay:.1f}s")
+        countApiCall(endpoint, "retries")
+        attempt += 1
+        time.sleep(delay)
+
+
+def logApiStats():
+    for endpoint, stats in sorted(api_stats.items()):
+        log_msg = f"{endpoint}: {stats['requests']} requests, {stats['retries']} retries, {stats['failures']} failures"
+        logging.info(log_msg)
+        print(log_msg)
+
+
+class RunMetrics:
+    """Durations, item counts, HTTP latency histograms and LDAP page timings of one sync run."""
+
+    # upper bounds in seconds of the HTTP latency histogram buckets
+    buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.http = {}
+        self.ldap_pages = {}
+        # seconds from the detection of a change to it being applied in XIQ, per write lane
+        self.applied = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.recordPhase(name, time.perf_counter() - started)
+
+    def recordPhase(self, name, seconds, items=None):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "items": 0})
+            phase["seconds"] += seconds
+            if items is not None:
+                phase["items"] += items
+
+    def countItems(self, name, items):
+        with self.lock:
+            self.phases.setdefault(name, {"seconds": 0.0, "items": 0})["items"] += items
+
+    def setCounter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def observeHttp(self, endpoint, seconds):
+        with self.lock:
+            histogram = self.http.setdefault(endpoint, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def observeLdapPage(self, ad_group, seconds, entries):
+        with self.lock:
+            pages = self.ldap_pages.setdefault(ad_group, {"pages": 0, "seconds": 0.0, "max_seconds": 0.0, "entries": 0})
+            pages["pages"] += 1
+            pages["seconds"] += seconds
+            pages["max_seconds"] = max(pages["max_seconds"], seconds)
+            pages["entries"] += entries
+
+    def observeApplied(self, lane, seconds):
+        with self.lock:
+            self.applied.setdefault(lane, []).append(seconds)
+
+    def laneLatency(self):
+        with self.lock:
+            lanes = {lane: sorted(values) for lane, values in self.applied.items()}
+        return {lane: {"applied": len(values), "mean": sum(values) / len(values), "p50": values[len(values) // 2],
+                       "p95": values[min(len(values) - 1, len(values) * 95 // 100)], "max": values[-1]} for lane, values in lanes.items()}
+
+    def report(self, status):
+        lanes = self.laneLatency()
+        with api_stats_lock:
+            stats = {endpoint: dict(counts) for endpoint, counts in api_stats.items()}
+        with self.lock:
+            # endpoints whose requests all failed have counts but no latencies
+            endpoints = list(self.http) + [endpoint for endpoint in stats if endpoint not in self.http]
+            empty = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            return {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "status": status,
+                "phases": self.phases,
+                "counters": self.counters,
+                "http": {endpoint: dict(self.http.get(endpoint, empty), le=self.buckets, **stats.get(endpoint, {})) for endpoint in endpoints},
+                "ldap_pages": self.ldap_pages,
+                "lanes": lanes
+            }
+
+
+run_metrics = RunMetrics()
+
+
+def writeFileAtomic(path, text):
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, path)
+
+
+def prometheusLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheusText(report):
+    lines = []
+
+    def metric(name, help_text, samples, metric_type="gauge"):
+        lines.append(f"# HELP xiq_ad_sync_{name} {help_text}")
+        lines.append(f"# TYPE xiq_ad_sync_{name} {metric_type}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{prometheusLabel(label)}"' for key, label in labels.items())
+            lines.append(f"xiq_ad_sync_{name}{{{label_text}}} {value}" if label_text else f"xiq_ad_sync_{name} {value}")
+
+    metric("last_run_timestamp_seconds", "Start time of the last sync run", [({}, report["started"])])
+    metric("last_run_seconds", "Duration of the last sync run", [({}, report["seconds"])])
+    metric("last_run_success", "1 if the last sync run completed", [({}, 1 if report["status"] == "success" else 0)])
+    metric("phase_seconds", "Duration of each phase of the last sync run", [({"phase": name}, phase["seconds"]) for name, phase in report["phases"].items()])
+    metric("phase_items", "Items handled by each phase of the last sync run", [({"phase": name}, phase["items"]) for name, phase in report["phases"].items()])
+    metric("count", "Counters of the last sync run", [({"name": name}, value) for name, value in report["counters"].items()])
+    lines.append("# HELP xiq_ad_sync_http_request_duration_seconds XIQ API request latency of the last sync run")
+    lines.append("# TYPE xiq_ad_sync_http_request_duration_seconds histogram")
+    for endpoint, histogram in report["http"].items():
+        label = prometheusLabel(endpoint)
+        for bound, count in zip(histogram["le"], histogram["buckets"]):
+            lines.append(f'xiq_ad_sync_http_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {count}')
+        lines.append(f'xiq_ad_sync_http_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'xiq_ad_sync_http_request_duration_seconds_sum{{endpoint="{label}"}} {histogram["sum"]}')
+        lines.append(f'xiq_ad_sync_http_request_duration_seconds_count{{endpoint="{label}"}} {histogram["count"]}')
+    for counter in ("requests", "retries", "failures"):
+        metric(f"http_{counter}", f"XIQ API {counter} of the last sync run", [({"endpoint": endpoint}, histogram.get(counter, 0)) for endpoint, histogram in report["http"].items()])
+    metric("ldap_pages", "AD search pages read per group in the last sync run", [({"group": group}, pages["pages"]) for group, pages in report["ldap_pages"].items()])
+    metric("ldap_page_seconds", "Time spent reading AD search pages per group in the last sync run", [({"group": group}, pages["seconds"]) for group, pages in report["ldap_pages"].items()])
+    metric("ldap_page_max_seconds", "Slowest AD search page per group in the last sync run", [({"group": group}, pages["max_seconds"]) for group, pages in report["ldap_pages"].items()])
+    metric("ldap_entries", "AD entries read per group in the last sync run", [({"group": group}, pages["entries"]) for group, pages in report["ldap_pages"].items()])
+    metric("lane_applied", "Changes applied per write lane in the last sync run", [({"lane": lane}, latency["applied"]) for lane, latency in report["lanes"].items()])
+    metric("lane_latency_seconds", "Seconds from detection to applied change per write lane in the last sync run",
+           [({"lane": lane, "quantile": quantile}, latency[key]) for lane, latency in report["lanes"].items() for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("1", "max"))])
+    return '\n'.join(lines) + '\n'
+
+
+def writeRunReport(status):
+    # Writes the metrics of the run to metrics_json_file and metrics_prom_file (Prometheus textfile collector)
+    report = run_metrics.report(status)
+    try:
+        if metrics_json_file:
+            writeFileAtomic(metrics_json_file, json.dumps(report, indent=2))
+        if metrics_prom_file:
+            writeFileAtomic(metrics_prom_file, prometheusText(report))
+    except OSError as e:
+        logging.error(f"Unable to write the run report: {e}")
+
+
+# Compact records holding only the fields the sync uses, in place of ldap3 Entry objects and XIQ JSON
+# dicts. ADEntry keeps the ldap3 attribute names, its name is None when the entry could not be read.
+ADEntry = namedtuple('ADEntry', ['entry_dn', 'objectGUID', 'name', 'sAMAccountName', 'mail', 'userAccountControl'])
+LDAPUser = namedtuple('LDAPUser', ['userAccountControl', 'email', 'username', 'xiq_role', 'guid'], defaults=[None])
+XIQUser = namedtuple('XIQUser', ['id', 'user_name', 'email_address', 'user_group_id'])
+PCGUser = namedtuple('PCGUser', ['id', 'name', 'email', 'user_group_name'])
+
+
+def compactADEntry(entry):
+    # str() of an ldap3 attribute gives '[]' for a missing value, which is how users without an email are found
+    try:
+        raw_guid = entry.entry_raw_attributes.get('objectGUID')
+        return ADEntry(entry.entry_dn, raw_guid[0].hex() if raw_guid else None, str(entry.name), str(entry.sAMAccountName),
+                       str(entry.mail), sys.intern(str(entry.userAccountControl)))
+    except LDAPException:
+        return ADEntry(entry.entry_dn, None, None, None, None, None)
+
+
+def discoverDCs():
+    # Host names of the domain controllers of domain_name from DNS, by SRV priority and weight
+    if dns is None:
+        logging.warning("AD_discover_dcs needs dnspython (pip install dnspython), using server_name and AD_servers")
+        return []
+    try:
+        answers = dns.resolver.resolve(f"_ldap._tcp.dc._msdcs.{domain_name}", 'SRV', lifetime=AD_connect_timeout)
+    except dns.exception.DNSException as e:
+        logging.warning(f"Unable to discover the domain controllers of {domain_name}: {e}")
+        return []
+    return [str(answer.target).rstrip('.') for answer in sorted(answers, key=lambda answer: (answer.priority, -answer.weight))]
+
+
+class ADConnectionPool:
+    """Bound AD connections shared by every group search, spread over the domain controllers.
+
+    The DCs (server_name and AD_servers, or the ones found in DNS) are probed with a bind every
+    AD_dc_retry seconds. A connection goes to the DC with the lowest bind time times the connections
+    it already has in use, so the fastest DC gets most of the searches without taking all of them. A
+    DC that fails is left out until the next probe and the search is restarted on another DC, unless
+    the pool is pinned to one DC.
+
+    Connections are bound once and reused, at most AD_connections at a time. The server schema is
+    only downloaded when AD_schema_info is set, and is then kept on the shared Server objects.
+    """
+
+    def __init__(self, size):
+        self.hosts = []
+        self.servers = {}
+        self.idle = {}
+        # bind seconds of the DCs that answered the last probe, connections in use and time of failure per DC
+        self.latency = {}
+        self.in_use = {}
+        self.failed_at = {}
+        self.pinned = None
+        self.probed = None
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()
+
+    def connect(self, host):
+        with self.lock:
+            if host not in self.servers:
+                self.servers[host] = Server(host, get_info=SCHEMA if AD_schema_info else NONE, connect_timeout=AD_connect_timeout)
+            server = self.servers[host]
+        return Connection(server, user='{}\\{}'.format(domain_name, user_name), password=password, authentication=NTLM, auto_bind=True)
+
+    def probe(self):
+        # Binds to every DC at the same time. A probe connection is kept for the searches when its DC has no
+        # idle connection, else it is unbound so repeated probes don't pile up connections.
+        hosts = list(dict.fromkeys((discoverDCs() if AD_discover_dcs else []) or [server_name] + list(AD_servers)))
+
+        def timed(host):
+            started = time.perf_counter()
+            try:
+                conn = self.connect(host)
+            except LDAPException as e:
+                return host, None, e
+            return host, time.perf_counter() - started, conn
+
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            results = list(executor.map(timed, hosts))
+        with self.lock:
+            self.hosts = hosts
+            self.latency = {}
+            for host, seconds, result in results:
+                if seconds is None:
+                    self.failed_at[host] = time.monotonic()
+                    logging.warning(f"Unable to bind to domain controller {host}: {result}")
+                    continue
+                self.latency[host] = seconds
+                self.failed_at.pop(host, None)
+            self.probed = time.monotonic()
+        for host, seconds, result in results:
+            if seconds is not None:
+                self.checkin(host, result, limit=1)
+        if len(hosts) > 1:
+            logging.info("Domain controllers by bind time: " + ", ".join(f"{host} {seconds:.3f}s" for host, seconds in sorted(self.latency.items(), key=lambda item: item[1])))
+
+    def candidates(self):
+        # DCs to try, best first. Called with the lock held.
+        if self.pinned:
+            return [self.pinned]
+        healthy = [host for host in self.latency if host not in self.failed_at]
+        if not healthy:
+            # nothing answered, try them all anyway
+            return list(self.hosts)
+        return sorted(healthy, key=lambda host: self.latency[host] * (self.in_use.get(host, 0) + 1))
+
+    def ensureProbed(self):
+        with self.probe_lock:
+            if self.probed is None or time.monotonic() - self.probed > AD_dc_retry:
+                self.probe()
+
+    def pin(self, preferred=None):
+        # Sends every connection to one DC, preferred when it answers and else the fastest, and returns it.
+        # USNs only mean something on the DC they were read from, so an incremental AD read can't move.
+        self.ensureProbed()
+        with self.lock:
+            self.pinned = None
+            hosts = self.candidates()
+            self.pinned = preferred if preferred in hosts else hosts[0]
+            return self.pinned
+
+    def failed(self, host, error):
+        with self.lock:
+            self.failed_at[host] = time.monotonic()
+            idle = self.idle.pop(host, queue.LifoQueue())
+        if not self.pinned and len(self.hosts) > 1:
+            logging.warning(f"Domain controller {host} failed ({error}), using the other domain controllers until the next probe")
+        while not idle.empty():
+            try:
+                idle.get_nowait().unbind()
+            except LDAPException:
+                pass
+
+    def checkout(self):
+        # A bound connection and its DC, from the first candidate DC that can give one
+        error = None
+        with self.lock:
+            hosts = self.candidates()
+        for host in hosts:
+            with self.lock:
+                self.in_use[host] = self.in_use.get(host, 0) + 1
+                idle = self.idle.setdefault(host, queue.LifoQueue())
+            try:
+                conn = idle.get_nowait()
+            except queue.Empty:
+                conn = None
+            try:
+                if conn is None or conn.closed:
+                    conn = self.connect(host)
+                return conn, host
+            except LDAPException as e:
+                error = e
+                self.release(host)
+                self.failed(host, e)
+        raise error
+
+    def checkin(self, host, conn, limit=None):
+        # Returns conn to the idle connections of host, or unbinds it when host already has limit
+        # (default AD_connections) of them
+        with self.lock:
+            idle = self.idle.setdefault(host, queue.LifoQueue())
+            if idle.qsize() < (limit or AD_connections):
+                idle.put(conn)
+                return
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def release(self, host):
+        with self.lock:
+            self.in_use[host] -= 1
+
+    @contextmanager
+    def connection(self):
+        # A connection that fails with a communication error is dropped and its DC marked failed, the
+        # next caller gets a connection to another DC
+        self.slots.acquire()
+        try:
+            self.ensureProbed()
+            conn, host = self.checkout()
+            try:
+                yield conn
+            except LDAPCommunicationError as e:
+                try:
+                    conn.unbind()
+                except LDAPException:
+                    pass
+                self.failed(host, e)
+                raise
+            except:
+                self.checkin(host, conn)
+                raise
+            finally:
+                self.release(host)
+            self.checkin(host, conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle = list(self.idle.values())
+            self.idle = {}
+        for connections in idle:
+            while not connections.empty():
+                conn = connections.get_nowait()
+                try:
+                    conn.unbind()
+                except LDAPException:
+                    pass
+
+
+ad_pool = None
+
+
+def getADPool():
+    global ad_pool
+    if ad_pool is None:
+        ad_pool = ADConnectionPool(AD_connections)
+    return ad_pool
+
+
+# settings an AD tuning report may set, with a check of their value
+ad_tuning_settings = {
+    'page': lambda value: isinstance(value, int) and not isinstance(value, bool) and value > 0,
+    'AD_group_expansion': lambda value: value in ('matching_rule', 'member')
+}
+
+
+def loadADTuning(path):
+    # Returns the settings of the AD_Test.py tuning report at path, {} when there is none or it can't be used
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            settings = json.load(f)['settings']
+        tuning = {key: settings[key] for key in ad_tuning_settings if key in settings}
+        invalid = [key for key, value in tuning.items() if not ad_tuning_settings[key](value)]
+        if invalid:
+            raise ValueError(f"invalid value for {', '.join(invalid)}")
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Ignoring AD tuning report {path}: {e}")
+        return {}
+    logging.info(f"Using AD tuning report {path}: {tuning}")
+    return tuning
+
+
+def accountDisabled(user_account_control):
+    # user_account_control is the attribute as a string, '[]' when it wasn't returned
+    try:
+        return bool(int(user_account_control) & UF_ACCOUNTDISABLE)
+    except ValueError:
+        return False
+
+
+def adUserFilter(usn_changed=None):
+    # AD_Filter with the conditions every AD user search adds to it. Disabled accounts are only left out of
+    # full reads, a read of the changed users has to return them so the cached copy becomes disabled.
+    search_filter = AD_Filter
+    if usn_changed is not None:
+        search_filter += '(uSNChanged>={})'.format(usn_changed)
+    elif AD_exclude_disabled:
+        search_filter += '(!(userAccountControl:1.2.840.113556.1.4.803:={}))'.format(UF_ACCOUNTDISABLE)
+    return search_filter
+
+
+def getSearchBase():
     #Building search base from fqdn
     subdir_list = domain_name.split('.')
     tdl = subdir_list[-1]
     subdir_list = subdir_list[:-1]
     if subdir_list:
-        SearchBase = 'DC=' + ',DC='.join(subdir_list) + ',DC=' + tdl
-    else:
-        SearchBase = 'DC=' + tdl
+        return 'DC=' + ',DC='.join(subdir_list) + ',DC=' + tdl
+    return 'DC=' + tdl
+
+
+def retrieveADUsers(ad_group, on_page=None, usn_changed=None):
+    # Pages are passed to on_page as they arrive when it is set, otherwise all entries are returned.
+    # With usn_changed only users changed at or after that USN are returned. With AD_shards a full read
+    # is split into sAMAccountName ranges searched at the same time.
+    SearchBase = getSearchBase()
+    search_filter = '(&(objectClass=user)({}={}){})'.format('memberof:1.2.840.113556.1.4.1941:' if AD_nested_groups else 'memberOf', ad_group, adUserFilter(usn_changed))
+    # only what compactADEntry keeps
+    attributes = ['userAccountControl', 'sAMAccountName', 'name', 'mail', 'objectGUID']
+    sharded = AD_shards > 1 and usn_changed is None and AD_group_expansion != 'member'
     ad_result = []
-    try:
-        server = Server(server_name, get_info=ALL)
-        conn = Connection(server, user='{}\\{}'.format(domain_name, user_name), password=password, authentication=NTLM, auto_bind=True)
-        conn.search(
-            search_base= SearchBase,
-            search_filter='(&(objectClass=user)(memberof:1.2.840.113556.1.4.1941:={}){})'.format(ad_group,AD_Filter),
-            search_scope=SUBTREE,
-            attributes = ['objectClass', 'userAccountControl', 'sAMAccountName', 'name', 'mail'],
-            paged_size = page)
-        ad_result.extend(conn.entries)
-        print(f"completed page of AD Users. Total Users collected is {len(ad_result)}")
-        cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-        while cookie:
-            conn.search(
-                search_base= SearchBase,
-                search_filter='(&(objectClass=user)(memberof:1.2.840.113556.1.4.1941:={}){})'.format(ad_group,AD_Filter),
-                search_scope=SUBTREE,
-                attributes = ['objectClass', 'userAccountControl', 'sAMAccountName', 'name', 'mail'],
-                paged_size = page,
-                paged_cookie = cookie)
-            ad_result.extend(conn.entries)
-            print(f"completed page of AD Users. Total Users collected is {len(ad_result)}")
-            cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-        conn.unbind()
+    # DNs already handed out, so a search restarted after a lost connection doesn't repeat entries
+    delivered = set()
+    # sAMAccountNames read by a sharded search, for the shard boundaries of the next run
+    names = []
+    lock = threading.Lock()
+
+    def deliver(entries):
+        with lock:
+            entries = [entry for entry in entries if entry.entry_dn not in delivered]
+            delivered.update(entry.entry_dn for entry in entries)
+            if sharded:
+                names.extend(entry.sAMAccountName.lower() for entry in entries if entry.sAMAccountName is not None)
+            if not on_page:
+                ad_result.extend(entries)
+        if on_page:
+            on_page(entries)
+        progress.advance("AD users", len(entries))
+
+    def search(shard_filter, label):
+        attempt = 0
+        while True:
+            try:
+                with getADPool().connection() as conn:
+                    if AD_group_expansion == 'member':
+                        (ad_expander or GroupExpander()).expand(conn, ad_group, deliver, usn_changed)
+                        return
+                    cookie = None
+                    while True:
+                        started = time.perf_counter()
+                        conn.search(
+                            search_base= SearchBase,
+                            search_filter='(&{}{})'.format(search_filter, shard_filter) if shard_filter else search_filter,
+                            search_scope=SUBTREE,
+                            attributes = attributes,
+                            paged_size = page,
+                            paged_cookie = cookie)
+                        if conn.result['result'] in (51, 52):
+                            # busy or unavailable, the search is worth restarting on another DC
+                            raise LDAPCommunicationError(f"{conn.result['description']} from {conn.server.host}")
+                        run_metrics.observeLdapPage(label, time.perf_counter() - started, len(conn.entries))
+                        deliver([compactADEntry(entry) for entry in conn.entries])
+                        cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+                        if not cookie:
+                            break
+                return
+            except LDAPCommunicationError as e:
+                if attempt < AD_reconnect_attempts:
+                    attempt += 1
+                    log_msg = f"Lost connection to AD while reading {label} ({e}), reconnecting ({attempt}/{AD_reconnect_attempts})"
+                    logging.warning(log_msg)
+                    print(log_msg)
+                    continue
+                log_msg = f"Unable to reach server {server_name}"
+                logging.error(log_msg)
+                print(log_msg)
+                print("script exiting....")
+                raise SystemExit
+            except:
+                log_msg = f"Unable to reach server {server_name}"
+                logging.error(log_msg)
+                print(log_msg)
+                print("script exiting....")
+                raise SystemExit
+
+    if not sharded:
+        search(None, ad_group)
         return ad_result
-    except:
-        log_msg = f"Unable to reach server {server_name}"
-        logging.error(log_msg)
-        print(log_msg)
-        print("script exiting....")
-        raise SystemExit
-    
+    shard_filters = shardFilters(ad_group)
+    with ThreadPoolExecutor(max_workers=len(shard_filters)) as executor:
+        futures = [executor.submit(search, shard_filter, f"{ad_group} [shard {i + 1}/{len(shard_filters)}]") for i, shard_filter in enumerate(shard_filters)]
+        for future in futures:
+            future.result()
+    updateShardBounds(ad_group, names)
+    return ad_result
+
+
+# ad_group -> {"shards": AD_shards, "bounds": sAMAccountName boundaries}, from AD_shard_file
+ad_shard_bounds = None
+
+
+def loadADShards():
+    global ad_shard_bounds
+    if ad_shard_bounds is None:
+        try:
+            with open(AD_shard_file) as f:
+                ad_shard_bounds = json.load(f)
+        except FileNotFoundError:
+            ad_shard_bounds = {}
+        except ValueError:
+            logging.warning(f"AD shard file {AD_shard_file} is not valid, using the default shard boundaries")
+            ad_shard_bounds = {}
+    return ad_shard_bounds
+
+
+def saveADShards():
+    if ad_shard_bounds is None:
+        return
+    try:
+        writeFileAtomic(AD_shard_file, json.dumps(ad_shard_bounds, indent=2))
+    except OSError as e:
+        logging.warning(f"Unable to write the AD shard file {AD_shard_file}: {e}")
+
+
+def shardFilters(ad_group):
+    # sAMAccountName range filters that together match every user of ad_group once. The boundaries split
+    # the users of the last run evenly, the first run splits the alphabet.
+    shards = loadADShards().get(ad_group)
+    if shards and shards.get("shards") == AD_shards:
+        bounds = shards["bounds"]
+    else:
+        chars = '0123456789abcdefghijklmnopqrstuvwxyz'
+        bounds = sorted(set(chars[len(chars) * i // AD_shards] for i in range(1, AD_shards)))
+    filters = []
+    lower = None
+    for upper in bounds + [None]:
+        shard_filter = ''
+        if lower is not None:
+            shard_filter += '(sAMAccountName>={})'.format(escape_filter_chars(lower))
+        if upper is not None:
+            shard_filter += '(!(sAMAccountName>={}))'.format(escape_filter_chars(upper))
+        filters.append(shard_filter)
+        lower = upper
+    # a user without a sAMAccountName matches neither side of a boundary
+    filters[0] = '(|(!(sAMAccountName=*)){})'.format(filters[0])
+    return filters
+
+
+def updateShardBounds(ad_group, names):
+    # Boundaries that split names into AD_shards equal parts, used by the next run
+    names.sort()
+    if len(names) < AD_shards:
+        return
+    bounds = sorted(set(names[len(names) * i // AD_shards] for i in range(1, AD_shards)))
+    loadADShards()[ad_group] = {"shards": AD_shards, "bounds": bounds}
+
+
+class GroupExpander:
+    """Finds group members from the member attribute of the groups (AD_group_expansion = 'member').
+
+    Member DNs are read in batches of batch_size with an OR of distinguishedName filters and kept
+    for the run, so a user or group in several mapped groups is read once. Nested groups are
+    followed when AD_nested_groups is set, each group once per expansion so loops end. ldap3 follows
+    the ranged retrieval (member;range=...) AD uses for groups with more than 1500 members.
+    """
+
+    batch_size = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # lower case DN -> ADEntry for users, list of member DNs for groups, None for anything else
+        self.objects = {}
+        # lower case DN -> Event set once the thread reading it is done
+        self.pending = {}
+
+    def groupMembers(self, conn, group_dn):
+        with self.lock:
+            members = self.objects.get(group_dn.lower())
+        if isinstance(members, list):
+            return members
+        started = time.perf_counter()
+        conn.search(group_dn, '(objectClass=group)', BASE, attributes=['member'])
+        run_metrics.observeLdapPage(group_dn, time.perf_counter() - started, len(conn.entries))
+        members = list(conn.entries[0].entry_attributes_as_dict.get('member', [])) if conn.entries else []
+        with self.lock:
+            self.objects[group_dn.lower()] = members
+        return members
+
+    def readBatch(self, conn, dns, usn_changed, label):
+        user_filter = '(&(objectClass=user){})'.format(adUserFilter(usn_changed))
+        search_filter = '(&(|{})(|(objectClass=group){}))'.format(''.join('(distinguishedName={})'.format(escape_filter_chars(dn)) for dn in dns), user_filter)
+        attributes = ['objectClass', 'member', 'userAccountControl', 'sAMAccountName', 'name', 'mail', 'objectGUID']
+        started = time.perf_counter()
+        conn.search(getSearchBase(), search_filter, SUBTREE, attributes=attributes)
+        run_metrics.observeLdapPage(label, time.perf_counter() - started, len(conn.entries))
+        found = {}
+        for entry in conn.entries:
+            attributes = entry.entry_attributes_as_dict
+            if 'group' in [value.lower() for value in attributes.get('objectClass', [])]:
+                found[entry.entry_dn.lower()] = list(attributes.get('member', []))
+            else:
+                found[entry.entry_dn.lower()] = compactADEntry(entry)
+        with self.lock:
+            self.objects.update(found)
+
+    def resolve(self, conn, dns, usn_changed, label):
+        # Reads the DNs not known yet. DNs another thread is reading are waited for, and read here
+        # when that thread failed.
+        while True:
+            event = threading.Event()
+            todo = []
+            waits = []
+            with self.lock:
+                for dn in dns:
+                    key = dn.lower()
+                    if key in self.objects:
+                        continue
+                    if key in self.pending:
+                        waits.append(self.pending[key])
+                    else:
+                        self.pending[key] = event
+                        todo.append(dn)
+            if not todo and not waits:
+                return
+            done = False
+            try:
+                for i in range(0, len(todo), self.batch_size):
+                    self.readBatch(conn, todo[i:i + self.batch_size], usn_changed, label)
+                done = True
+            finally:
+                with self.lock:
+                    for dn in todo:
+                        key = dn.lower()
+                        if done:
+                            # not a user (or filtered out) and not a group
+                            self.objects.setdefault(key, None)
+                        self.pending.pop(key, None)
+                event.set()
+            for wait in waits:
+                wait.wait()
+
+    def walk(self, conn, ad_group, usn_changed):
+        # Yields (group DN, member objects) for ad_group and, with AD_nested_groups, the groups in it
+        seen = {ad_group.lower()}
+        groups = [ad_group]
+        while groups:
+            group_dn = groups.pop()
+            members = self.groupMembers(conn, group_dn)
+            self.resolve(conn, members, usn_changed, ad_group)
+            with self.lock:
+                objects = [(dn, self.objects.get(dn.lower())) for dn in members]
+            for dn, member in objects:
+                if isinstance(member, list) and AD_nested_groups and dn.lower() not in seen:
+                    seen.add(dn.lower())
+                    groups.append(dn)
+            yield group_dn, [member for dn, member in objects]
+
+    def expand(self, conn, ad_group, deliver, usn_changed=None):
+        for group_dn, members in self.walk(conn, ad_group, usn_changed):
+            deliver([member for member in members if isinstance(member, ADEntry)])
+
+    def nestedGroups(self, conn, ad_group):
+        # lower case DNs of the groups nested in ad_group
+        return set(group_dn.lower() for group_dn, members in self.walk(conn, ad_group, None)) - {ad_group.lower()}
+
+
+# Members read by the 'member' expansion, shared by all group_roles of a run
+ad_expander = None
+
+
+def pagedSearch(conn, search_base, search_filter, attributes, controls=None):
+    # Generator over all entries of a paged search, returned as ldap3 response dicts
+    return conn.extend.standard.paged_search(search_base, search_filter, SUBTREE, attributes=attributes, controls=controls, paged_size=page, generator=True)
+
+
+def readADWatermark(conn):
+    # highestCommittedUSN and invocationId of the DC. USNs are local to a DC and only comparable
+    # while its invocationId is unchanged (a restore from backup changes it).
+    conn.search('', '(objectClass=*)', BASE, attributes=['highestCommittedUSN', 'dsServiceName'])
+    root_dse = conn.response[0]['raw_attributes']
+    usn = int(root_dse['highestCommittedUSN'][0])
+    ds_service_name = root_dse['dsServiceName'][0].decode()
+    conn.search(ds_service_name, '(objectClass=*)', BASE, attributes=['invocationId'])
+    invocation_id = conn.response[0]['raw_attributes']['invocationId'][0].hex()
+    return usn, invocation_id
+
+
+ad_state_cache = None
+
+
+def loadADState():
+    # the daemon keeps the state of the last cycle in memory instead of reading the file again
+    if ad_state_cache is not None:
+        return ad_state_cache
+    try:
+        with open(AD_state_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning(f"AD state file {AD_state_file} is not valid, running a full AD resync")
+        return {}
+
+
+def saveADState(ad_state):
+    # written to a temp file first so an interrupted run never leaves a truncated state file. Only the
+    # owner can read it, it holds the names and emails of every cached user.
+    tmp_file = AD_state_file + '.tmp'
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump({key: value for key, value in ad_state.items() if key not in ('mode', 'deleted', 'lock', 'new_usn')}, f)
+    os.replace(tmp_file, AD_state_file)
+    global ad_state_cache
+    ad_state_cache = ad_state
+
+
+def prepareADState():
+    # Decides between a full and an incremental AD read and returns the state used by collectADGroup.
+    # A full resync is done when there is no usable watermark, the DC or its invocationId changed,
+    # AD_full_resync_hours have passed, group_roles changed or a group that feeds a mapped group changed.
+    ad_state = loadADState()
+    SearchBase = getSearchBase()
+    ad_groups = sorted(ad_group for ad_group, xiq_user_role in group_roles)
+    # every read of the run goes to the DC the watermark is read from, the one of the last run if it answers
+    host = getADPool().pin(ad_state.get('server'))
+    with getADPool().connection() as conn:
+        usn, invocation_id = readADWatermark(conn)
+        reason = None
+        if not ad_state:
+            reason = "no previous AD state"
+        elif ad_state.get('server') != host or ad_state.get('invocation_id') != invocation_id:
+            reason = "domain controller changed"
+        elif ad_state['usn'] > usn:
+            reason = "watermark is ahead of the domain controller"
+        elif time.time() - ad_state['last_full'] > AD_full_resync_hours * 3600:
+            reason = "full resync interval reached"
+        elif sorted(ad_state['groups']) != ad_groups:
+            reason = "group_roles changed"
+        elif ad_state.get('fields') != list(ADEntry._fields):
+            reason = "cached user format changed"
+        else:
+            group_dns = set(ad_state['group_dns'])
+            for entry in pagedSearch(conn, SearchBase, '(&(objectClass=group)(uSNChanged>={}))'.format(ad_state['usn'] + 1), ['cn']):
+                if entry.get('dn', '').lower() in group_dns:
+                    reason = f"group {entry['dn']} changed"
+                    break
+        if reason is None:
+            # users deleted since the last run are only visible as tombstones
+            deleted = set()
+            for entry in pagedSearch(conn, SearchBase, '(&(objectClass=user)(isDeleted=TRUE)(uSNChanged>={}))'.format(ad_state['usn'] + 1), ['objectGUID'], controls=[('1.2.840.113556.1.4.417', True, None)]):
+                if 'raw_attributes' in entry:
+                    deleted.add(entry['raw_attributes']['objectGUID'][0].hex())
+            ad_state['mode'] = 'incremental'
+            ad_state['deleted'] = deleted
+            log_msg = f"Running incremental AD sync for changes after USN {ad_state['usn']}"
+        else:
+            # groups nested in the mapped groups, a change to any of them forces the next full resync
+            group_dns = set(ad_group.lower() for ad_group in ad_groups)
+            for ad_group in ad_groups if AD_nested_groups else []:
+                if AD_group_expansion == 'member':
+                    group_dns.update(ad_expander.nestedGroups(conn, ad_group))
+                    continue
+                for entry in pagedSearch(conn, SearchBase, '(&(objectClass=group)(memberof:1.2.840.113556.1.4.1941:={}))'.format(ad_group), ['cn']):
+                    if 'dn' in entry:
+                        group_dns.add(entry['dn'].lower())
+            ad_state = {'mode': 'full', 'last_full': time.time(), 'fields': list(ADEntry._fields), 'group_dns': sorted(group_dns), 'groups': {ad_group: {} for ad_group in ad_groups}}
+            log_msg = f"Running full AD resync: {reason}"
+    ad_state.update({'server': host, 'invocation_id': invocation_id, 'new_usn': usn, 'lock': threading.Lock()})
+    logging.info(log_msg)
+    print(log_msg)
+    return ad_state
+
+
+def collectADGroup(ad_group, on_page, ad_state=None):
+    # Reads the members of ad_group into on_page. With incremental AD sync only the users changed
+    # since the last run are read from AD and the rest come from the cached group members.
+    if ad_state is None:
+        return retrieveADUsers(ad_group, on_page)
+    with ad_state['lock']:
+        members = ad_state['groups'].setdefault(ad_group, {})
+
+    def cache(entries):
+        for entry in entries:
+            if entry.name is not None:
+                members[entry.objectGUID] = list(entry)
+
+    if ad_state['mode'] == 'full':
+        return retrieveADUsers(ad_group, lambda entries: (cache(entries), on_page(entries)))
+    retrieveADUsers(ad_group, cache, usn_changed=ad_state['usn'] + 1)
+    for guid in ad_state['deleted']:
+        members.pop(guid, None)
+    on_page([ADEntry(*member) for member in members.values()])
 
 
 def getAccessToken(XIQ_username, XIQ_password):
     url = URL + "/login"
     payload = json.dumps({"username": XIQ_username, "password": XIQ_password})
-    response = requests.post(url, headers=headers, data=payload)
+    response = xiqRequest("POST", url, "POST /login", data=payload)
     if response is None:
         log_msg = "ERROR: Not able to login into ExtremeCloudIQ - no response!"
         logging.error(log_msg)
@@ -126,7 +1312,7 @@ def getAccessToken(XIQ_username, XIQ_password):
     if "access_token" in data:
         #print("Logged in and Got access token: " + data["access_token"])
         headers["Authorization"] = "Bearer " + data["access_token"]
-        return 0
+        return data
 
     else:
         log_msg = "Unknown Error: Unable to gain access token"
@@ -134,12 +1320,89 @@ def getAccessToken(XIQ_username, XIQ_password):
         raise TypeError(log_msg)
 
 
+def tokenExpiry(data):
+    # Expiry time of a /login response, from expires_in or else the exp claim of the JWT
+    if data.get('expires_in'):
+        return time.time() + float(data['expires_in'])
+    try:
+        claims = data['access_token'].split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4)))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+    """Keeps the access token of a XIQ_username/XIQ_password login valid for every thread.
+
+    The token and its expiry are cached in XIQ_token_file so later runs and daemon cycles skip the
+    login. It is renewed XIQ_token_refresh seconds (at most half its lifetime) before it expires, and
+    on a 401 only the first thread to see the rejected token logs in again while the others wait
+    for the new one.
+    """
+
+    def __init__(self, username, password, token_file):
+        self.username = username
+        self.password = password
+        self.token_file = token_file
+        self.refresh_at = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Uses the cached token when it is for this account and not due for renewal, else logs in
+        try:
+            with open(self.token_file) as f:
+                cached = json.load(f)
+            if (cached['url'] == URL and cached['username'] == self.username
+                    and (cached['refresh_at'] is None or cached['refresh_at'] > time.time())):
+                headers["Authorization"] = "Bearer " + cached['access_token']
+                self.refresh_at = cached['refresh_at']
+                logging.info("Using the cached XIQ access token")
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        with self.lock:
+            self.login()
+
+    def login(self):
+        data = getAccessToken(self.username, self.password)
+        expires_at = tokenExpiry(data)
+        self.refresh_at = None
+        if expires_at is not None:
+            now = time.time()
+            self.refresh_at = expires_at - min(XIQ_token_refresh, (expires_at - now) / 2)
+        if self.token_file:
+            cached = {"url": URL, "username": self.username, "access_token": data['access_token'], "refresh_at": self.refresh_at}
+            try:
+                tmp_file = self.token_file + '.tmp'
+                with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                    json.dump(cached, f)
+                os.replace(tmp_file, self.token_file)
+            except OSError as e:
+                logging.warning(f"Unable to cache the XIQ access token: {e}")
+
+    def ensureFresh(self):
+        if self.refresh_at is not None and time.time() >= self.refresh_at:
+            with self.lock:
+                if self.refresh_at is not None and time.time() >= self.refresh_at:
+                    logging.info("XIQ access token is about to expire, logging in again")
+                    self.login()
+
+    def refresh(self, rejected):
+        # rejected is the Authorization header XIQ answered with a 401
+        with self.lock:
+            if headers.get("Authorization") == rejected:
+                self.login()
+
+
+token_manager = None
+
+
 def createPPSKuser(name,mail, usergroupID):
     url = URL + "/endusers"
 
     payload = json.dumps({"user_group_id": usergroupID ,"name": name,"user_name": name,"password": "", "email_address": mail, "email_password_delivery": mail})
 
-    response = requests.post(url, headers=headers, data=payload, verify=True)
+    response = xiqRequest("POST", url, "POST /endusers", data=payload, verify=True)
     if response is None:
         log_msg = "Error adding PPSK user - no response!"
         logging.error(log_msg)
@@ -153,51 +1416,101 @@ def createPPSKuser(name,mail, usergroupID):
 
     elif response.status_code ==200:
         logging.info(f"successfully created PPSK user {name}")
-        print(f"successfully created PPSK user {name}")
+        if xiq_store is not None:
+            created = response.json()
+            if 'id' in created:
+                xiq_store.addEndUser(XIQUser(created['id'], name, mail, usergroupID), usergroupID)
+            else:
+                xiq_store.markStale(f"endusers:{usergroupID}")
         return True
 
 
 
 
-def retrievePPSKUsers(pageSize, usergroupID):
-    page = 1
-    pageCount = 1
-    firstCall = True
+def fetchPPSKPage(page, pageSize, usergroupID, probing=False):
+    # Returns the response of one page of end users of the user group. While probing the page size a
+    # 400 is expected and isn't counted as a failure.
+    url = URL + "/endusers?page=" + str(page) + "&limit=" + str(pageSize) + "&user_group_ids=" + usergroupID
+    return xiqRequest("GET", url, "GET /endusers", handled_status=400 if probing else None, verify=True)
 
-    ppskUsers = []
 
-    while page <= pageCount:
-        url = URL + "/endusers?page=" + str(page) + "&limit=" + str(pageSize) + "&user_group_ids=" + usergroupID
+def checkPPSKPage(response):
+    if response is None:
+        log_msg = "Error retrieving PPSK users from XIQ - no response!"
+        logging.error(log_msg)
+        raise TypeError(log_msg)
 
-        # Get the next page of the ppsk users
-        response = requests.get(url, headers=headers, verify = True)
-        if response is None:
-            log_msg = "Error retrieving PPSK users from XIQ - no response!"
-            logging.error(log_msg)
-            raise TypeError(log_msg)
+    elif response.status_code != 200:
+        log_msg = f"Error retrieving PPSK users from XIQ - HTTP Status Code: {str(response.status_code)}"
+        logging.error(log_msg)
+        logging.warning(f"\t\t{response.json()}")
+        raise TypeError(log_msg)
+    rawList = response.json()
+    return rawList, [XIQUser(user['id'], user['user_name'], user['email_address'], user['user_group_id']) for user in rawList['data']]
 
-        elif response.status_code != 200:
-            log_msg = f"Error retrieving PPSK users from XIQ - HTTP Status Code: {str(response.status_code)}"
-            logging.error(log_msg)
-            logging.warning(f"\t\t{response.json()}")
-            raise TypeError(log_msg)
 
-        rawList = response.json()
-        ppskUsers = ppskUsers + rawList['data']
+def retrievePPSKUsers(pageSize, usergroupID, on_page=None):
+    # Pages are passed to on_page as they arrive when it is set, otherwise all users are returned.
+    # The first page tells how many pages there are, the others are then fetched XIQ_page_workers
+    # at a time. A page size XIQ rejects (HTTP 400) is halved down to 100 and a page size XIQ caps is
+    # lowered to what it returned, the accepted size is kept in ppsk_page_size for the next calls.
+    global ppsk_page_size
+    if ppsk_page_size is not None:
+        pageSize = min(pageSize, ppsk_page_size)
 
-        if firstCall == True:
-            pageCount = rawList['total_pages']
-        print(f"completed page {page} of {rawList['total_pages']} collecting PPSK Users")
-        page = rawList['page'] + 1 
-    return ppskUsers
+    response = fetchPPSKPage(1, pageSize, usergroupID, probing=pageSize > 100)
+    while response is not None and response.status_code == 400 and pageSize > 100:
+        pageSize = max(100, pageSize // 2)
+        logging.info(f"XIQ rejected the end user page size, retrying with {pageSize}")
+        response = fetchPPSKPage(1, pageSize, usergroupID, probing=pageSize > 100)
+    rawList, pageUsers = checkPPSKPage(response)
+    pageCount = rawList['total_pages']
+    if pageCount > 1 and len(pageUsers) < pageSize:
+        pageSize = len(pageUsers)
+        logging.info(f"XIQ returned {pageSize} end users per page, using that page size")
+    ppsk_page_size = pageSize
 
+    ppskUsers = []
 
+    def deliver(page, pageUsers):
+        if on_page:
+            on_page(pageUsers)
+        else:
+            ppskUsers.extend(pageUsers)
+        progress.advance("XIQ users", len(pageUsers))
 
-def deleteUser(userId):
-    url = URL + "/endusers/" + str(userId)
-    response = requests.delete(url, headers=headers, verify=True)
+    deliver(1, pageUsers)
+    if pageCount > 1:
+        # pages are delivered in order, executor.map keeps fetching ahead while one is handed over
+        with ThreadPoolExecutor(max_workers=XIQ_page_workers) as executor:
+            pages = range(2, pageCount + 1)
+            results = executor.map(lambda page: checkPPSKPage(fetchPPSKPage(page, pageSize, usergroupID))[1], pages)
+            for page, pageUsers in zip(pages, results):
+                deliver(page, pageUsers)
+    return ppskUsers
+
+
+def countPPSKUsers(usergroupID):
+    # total number of end users XIQ reports for the user group
+    url = URL + "/endusers?page=1&limit=1&user_group_ids=" + usergroupID
+    response = xiqRequest("GET", url, "GET /endusers", verify=True)
     if response is None:
-        log_msg = f"Error deleting PPSK user {userId} - no response!"
+        log_msg = "Error counting PPSK users in XIQ - no response!"
+        logging.error(log_msg)
+        raise TypeError(log_msg)
+    elif response.status_code != 200:
+        log_msg = f"Error counting PPSK users in XIQ - HTTP Status Code: {str(response.status_code)}"
+        logging.error(log_msg)
+        logging.warning(f"\t\t{response.json()}")
+        raise TypeError(log_msg)
+    return response.json().get('total_count')
+
+
+def deleteUser(userId):
+    url = URL + "/endusers/" + str(userId)
+    response = xiqRequest("DELETE", url, "DELETE /endusers/{id}", verify=True)
+    if response is None:
+        log_msg = f"Error deleting PPSK user {userId} - no response!"
         logging.error(log_msg)
         raise TypeError(log_msg)
     elif response.status_code != 200:
@@ -206,322 +1519,1392 @@ def deleteUser(userId):
         logging.warning(f"\t\t{response.json()}")
         raise TypeError(log_msg)
     elif response.status_code == 200:
+        if xiq_store is not None:
+            xiq_store.deleteEndUser(userId)
         return 'Success', str(userId)
-    
 
-def addUserToPcg(policy_id, name, email, user_group_name):
-    url = URL + "/pcgs/key-based/network-policy-" + str(policy_id) + "/users"
-    payload = json.dumps({
-                  "users": [
-                    {
-                      "name": name,
-                      "email": email,
-                      "user_group_name": user_group_name
-                    }
-                  ]
-                })
-    response = requests.post(url, headers=headers, data=payload, verify=True)
+
+def updatePPSKUser(userId, name, mail, usergroupID):
+    # Renames the end user and/or changes its email. The user group of an end user can't be changed.
+    url = URL + "/endusers/" + str(userId)
+    payload = json.dumps({"name": name, "user_name": name, "email_address": mail, "email_password_delivery": mail})
+    response = xiqRequest("PUT", url, "PUT /endusers/{id}", data=payload, verify=True)
     if response is None:
-        log_msg = f"- no response!"
+        log_msg = f"Error updating PPSK user {name} - no response!"
         logging.error(log_msg)
         raise TypeError(log_msg)
     elif response.status_code != 200:
-        log_msg = f"HTTP Status Code: {str(response.status_code)}"
+        log_msg = f"Error updating PPSK user {name} - HTTP Status Code: {str(response.status_code)}"
         logging.error(log_msg)
-        logging.warning(f"\t\t{response}")
+        logging.warning(f"\t\t{response.json()}")
         raise TypeError(log_msg)
-    elif response.status_code == 200:
-        return 'Success'
+    if xiq_store is not None:
+        xiq_store.addEndUser(XIQUser(userId, name, mail, usergroupID), usergroupID)
+    return 'Success'
 
-def retrievePCGUsers(policy_id):
+
+class XIQStatusError(TypeError):
+    """An unexpected HTTP status from XIQ, raised as the TypeError callers already handle."""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def addUserToPcg(policy_id, users):
+    # users is a list of {"name", "email", "user_group_name"} dicts
     url = URL + "/pcgs/key-based/network-policy-" + str(policy_id) + "/users"
-    response = requests.get(url, headers=headers, verify = True)
+    payload = json.dumps({"users": users})
+    response = xiqRequest("POST", url, "POST /pcgs/key-based/network-policy-{id}/users", data=payload, verify=True)
     if response is None:
-        log_msg = f"Error retrieving PCG users for policy id {policy_id} from XIQ - no response!"
+        log_msg = f"- no response!"
         logging.error(log_msg)
         raise TypeError(log_msg)
     elif response.status_code != 200:
-        log_msg = f"Error retrieving PCG users for policy id {policy_id} from XIQ - HTTP Status Code: {str(response.status_code)}"
+        log_msg = f"HTTP Status Code: {str(response.status_code)}"
         logging.error(log_msg)
-        logging.warning(f"\t\t{response.json()}")
-        raise TypeError(log_msg)
-    rawList = response.json()
-    return rawList
+        logging.warning(f"\t\t{response}")
+        raise XIQStatusError(log_msg, response.status_code)
+    elif response.status_code == 200:
+        if xiq_store is not None:
+            # the ids XIQ gives the new PCG users are not returned, so the policy is read back next run
+            xiq_store.markStale(f"pcg:{policy_id}")
+        return 'Success'
+
+def fetchPCGPage(policy_id, page, pageSize, probing=False):
+    # Returns the response of one page of PCG users of the policy. While probing the page size a 400
+    # is expected and isn't counted as a failure.
+    url = URL + "/pcgs/key-based/network-policy-" + str(policy_id) + "/users?page=" + str(page) + "&limit=" + str(pageSize)
+    return xiqRequest("GET", url, "GET /pcgs/key-based/network-policy-{id}/users", handled_status=400 if probing else None, verify=True)
+
+
+def retrievePCGUsers(policy_id):
+    # Older XIQ releases return every PCG user of the policy as one list, paged responses (a dict with
+    # data and total_pages like the end users) are followed page by page. A page size XIQ rejects
+    # (HTTP 400) is halved down to 100, the accepted size is kept in pcg_page_size for the next calls.
+    global pcg_page_size
+    pageSize = XIQ_pcg_page_size
+    if pcg_page_size is not None:
+        pageSize = min(pageSize, pcg_page_size)
+    response = fetchPCGPage(policy_id, 1, pageSize, probing=pageSize > 100)
+    while response is not None and response.status_code == 400 and pageSize > 100:
+        pageSize = max(100, pageSize // 2)
+        logging.info(f"XIQ rejected the PCG user page size, retrying with {pageSize}")
+        response = fetchPCGPage(policy_id, 1, pageSize, probing=pageSize > 100)
+    PCGUsers = []
+    page = 1
+    pageCount = 1
+    while True:
+        if response is None:
+            log_msg = f"Error retrieving PCG users for policy id {policy_id} from XIQ - no response!"
+            logging.error(log_msg)
+            raise TypeError(log_msg)
+        elif response.status_code != 200:
+            log_msg = f"Error retrieving PCG users for policy id {policy_id} from XIQ - HTTP Status Code: {str(response.status_code)}"
+            logging.error(log_msg)
+            logging.warning(f"\t\t{response.json()}")
+            raise TypeError(log_msg)
+        rawList = response.json()
+        if isinstance(rawList, dict):
+            pageCount = rawList['total_pages']
+            rawList = rawList['data']
+        PCGUsers.extend(PCGUser(user['id'], user.get('name'), user['email'], user['user_group_name']) for user in rawList)
+        pcg_page_size = pageSize
+        page += 1
+        if page > pageCount:
+            return PCGUsers
+        response = fetchPCGPage(policy_id, page, pageSize)
 
-def deletePCGUsers(policy_id, userId):
+def deletePCGUsers(policy_id, userIds):
     url = URL + "/pcgs/key-based/network-policy-" + str(policy_id) + "/users"
-    payload = json.dumps({
-                    "user_ids": [
-                                    userId
-                                ]
-                })
-    response = requests.delete(url, headers=headers, data=payload, verify = True)
+    payload = json.dumps({"user_ids": userIds})
+    response = xiqRequest("DELETE", url, "DELETE /pcgs/key-based/network-policy-{id}/users", data=payload, verify=True)
     if response is None:
-        log_msg = f"Error deleting PPSK user {userId} - no response!"
+        log_msg = f"Error deleting PCG users {userIds} - no response!"
         logging.error(log_msg)
         raise TypeError(log_msg)
     elif response.status_code != 202:
-        log_msg = f"Error deleting PPSK user {userId} - HTTP Status Code: {str(response.status_code)}"
+        log_msg = f"Error deleting PCG users {userIds} - HTTP Status Code: {str(response.status_code)}"
         logging.error(log_msg)
         logging.warning(f"\t\t{response}")
-        raise TypeError(log_msg)
+        raise XIQStatusError(log_msg, response.status_code)
     elif response.status_code == 202:
+        if xiq_store is not None:
+            xiq_store.deletePCGUsers(policy_id, userIds)
         return 'Success'
 
 
-def main():
-    if 'XIQ_token' not in globals():
+def payloadRejected(status_code):
+    # A 4xx that points at the users sent, not at the token, the rate limit or the policy itself
+    return 400 <= status_code < 500 and status_code not in (401, 403, 404, 429)
+
+
+def sendPCGBatches(send, policy_id, items):
+    # Sends items to send(policy_id, chunk) in chunks of pcg_batch_size. A chunk XIQ rejects for its
+    # content is split in half and retried so a single bad user only fails itself. Any other failure
+    # (no response, 5xx, connection errors) fails the whole chunk. Returns (succeeded, failed) items.
+    succeeded = []
+    failed = []
+    pending = [items[i:i + pcg_batch_size] for i in range(0, len(items), pcg_batch_size)]
+    while pending:
+        chunk = pending.pop()
         try:
-            login = getAccessToken(XIQ_username, XIQ_password)
-        except TypeError as e:
-            print(e)
-            raise SystemExit
-        except:
-            log_msg = "Unknown Error: Failed to generate token"
+            send(policy_id, chunk)
+        except XIQStatusError as e:
+            if len(chunk) == 1 or not payloadRejected(e.status_code):
+                failed.extend(chunk)
+            else:
+                middle = len(chunk) // 2
+                pending.extend([chunk[middle:], chunk[:middle]])
+            continue
+        except (TypeError, requests.exceptions.RequestException):
+            failed.extend(chunk)
+            continue
+        succeeded.extend(chunk)
+    return succeeded, failed
+
+
+class XIQStateStore:
+    """SQLite copy of the XIQ end users and PCG users from the last run.
+
+    Rows are updated after every successful create and delete so a normal run can read the store
+    instead of paging through XIQ. A user group or policy is marked stale when the script changes it
+    in a way it can't mirror, which makes the next run read it back from XIQ.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS endusers (id PRIMARY KEY, user_name, email_address, user_group_id);
+            CREATE INDEX IF NOT EXISTS endusers_user_name ON endusers (user_name);
+            CREATE INDEX IF NOT EXISTS endusers_email ON endusers (email_address);
+            CREATE INDEX IF NOT EXISTS endusers_group ON endusers (user_group_id);
+            CREATE TABLE IF NOT EXISTS pcg_users (policy_id, id, name, email, user_group_name, PRIMARY KEY (policy_id, id));
+            CREATE INDEX IF NOT EXISTS pcg_users_email ON pcg_users (email);
+            CREATE TABLE IF NOT EXISTS verified (scope PRIMARY KEY, verified_at, stale);
+            CREATE TABLE IF NOT EXISTS fingerprints (name PRIMARY KEY, guid, xiq_id, fingerprint);
+        """)
+        self.db.commit()
+
+    def isFresh(self, scope):
+        # True when scope was read back from XIQ within XIQ_verify_hours and has not been marked stale
+        with self.lock:
+            row = self.db.execute("SELECT verified_at, stale FROM verified WHERE scope = ?", (scope,)).fetchone()
+        return row is not None and not row[1] and time.time() - row[0] < XIQ_verify_hours * 3600
+
+    def markVerified(self, scope):
+        self.db.execute("INSERT OR REPLACE INTO verified (scope, verified_at, stale) VALUES (?, ?, 0)", (scope, time.time()))
+
+    def markStale(self, scope):
+        with self.lock:
+            self.db.execute("UPDATE verified SET stale = 1 WHERE scope = ?", (scope,))
+            self.db.commit()
+
+    def endUsers(self, usergroupID):
+        with self.lock:
+            rows = self.db.execute("SELECT id, user_name, email_address, user_group_id FROM endusers WHERE user_group_id = ?", (usergroupID,)).fetchall()
+        return [XIQUser(*row) for row in rows]
+
+    def countEndUsers(self, usergroupID):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM endusers WHERE user_group_id = ?", (usergroupID,)).fetchone()[0]
+
+    def replaceEndUsers(self, usergroupID, users):
+        with self.lock:
+            self.db.execute("DELETE FROM endusers WHERE user_group_id = ?", (usergroupID,))
+            self.db.executemany("INSERT OR REPLACE INTO endusers (id, user_name, email_address, user_group_id) VALUES (?, ?, ?, ?)",
+                                [(user.id, user.user_name, user.email_address, usergroupID) for user in users])
+            self.markVerified(f"endusers:{usergroupID}")
+            self.db.commit()
+
+    def addEndUser(self, user, usergroupID):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO endusers (id, user_name, email_address, user_group_id) VALUES (?, ?, ?, ?)",
+                            (user.id, user.user_name, user.email_address, usergroupID))
+            self.db.commit()
+
+    def deleteEndUser(self, userId):
+        with self.lock:
+            self.db.execute("DELETE FROM endusers WHERE id = ?", (userId,))
+            self.db.commit()
+
+    def pcgUsers(self, policy_id):
+        with self.lock:
+            rows = self.db.execute("SELECT id, name, email, user_group_name FROM pcg_users WHERE policy_id = ?", (str(policy_id),)).fetchall()
+        return [PCGUser(*row) for row in rows]
+
+    def replacePCGUsers(self, policy_id, users):
+        with self.lock:
+            self.db.execute("DELETE FROM pcg_users WHERE policy_id = ?", (str(policy_id),))
+            self.db.executemany("INSERT OR REPLACE INTO pcg_users (policy_id, id, name, email, user_group_name) VALUES (?, ?, ?, ?, ?)",
+                                [(str(policy_id), user.id, user.name, user.email, user.user_group_name) for user in users])
+            self.markVerified(f"pcg:{policy_id}")
+            self.db.commit()
+
+    def deletePCGUsers(self, policy_id, userIds):
+        with self.lock:
+            self.db.executemany("DELETE FROM pcg_users WHERE policy_id = ? AND id = ?", [(str(policy_id), userId) for userId in userIds])
+            self.db.commit()
+
+    def fingerprints(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name, guid, xiq_id, fingerprint FROM fingerprints").fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def replaceFingerprints(self, fingerprints):
+        with self.lock:
+            self.db.execute("DELETE FROM fingerprints")
+            self.db.executemany("INSERT INTO fingerprints (name, guid, xiq_id, fingerprint) VALUES (?, ?, ?, ?)",
+                                [(name,) + tuple(record) for name, record in fingerprints.items()])
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+xiq_store = None
+# name -> (objectGUID, XIQ id, fingerprint) of the users that matched XIQ on the last run, kept here between
+# daemon cycles when there is no state store
+user_fingerprints = {}
+
+
+def collectPPSKGroup(usergroupID, on_page):
+    # Reads the end users of a user group into on_page, from the state store when it can be trusted.
+    # The store is trusted when it was verified within XIQ_verify_hours and its user count still
+    # matches the total_count XIQ reports for the group (a single one-record request).
+    if xiq_store is None:
+        return retrievePPSKUsers(XIQ_page_size, usergroupID, on_page)
+    if xiq_store.isFresh(f"endusers:{usergroupID}"):
+        total_count = countPPSKUsers(usergroupID)
+        stored_users = xiq_store.endUsers(usergroupID)
+        if total_count == len(stored_users):
+            on_page(stored_users)
+            print(f"loaded {len(stored_users)} PPSK Users of user group {usergroupID} from the state store")
+            return
+        logging.info(f"XIQ reports {total_count} users in user group {usergroupID} but the state store has {len(stored_users)}, reading them back from XIQ")
+    users = []
+    retrievePPSKUsers(XIQ_page_size, usergroupID, lambda page_users: (users.extend(page_users), on_page(page_users)))
+    xiq_store.replaceEndUsers(usergroupID, users)
+
+
+def collectPCGUsers(policy_id):
+    if xiq_store is not None and xiq_store.isFresh(f"pcg:{policy_id}"):
+        return xiq_store.pcgUsers(policy_id)
+    PCGUsers = retrievePCGUsers(policy_id)
+    if xiq_store is not None:
+        xiq_store.replacePCGUsers(policy_id, PCGUsers)
+    return PCGUsers
+
+
+def userFingerprint(details):
+    # Hash of the AD values that are synced to XIQ
+    values = "\0".join([details.username, details.email, details.userAccountControl, str(details.xiq_role)])
+    return hashlib.blake2b(values.encode(), digest_size=8).hexdigest()
+
+
+class UserIndex:
+    """Keyed view of the AD and XIQ users so each sync decision is a dict/set lookup.
+
+    Pages from the AD and XIQ collection threads are added as they arrive. fingerprints holds the
+    name -> (objectGUID, XIQ id, fingerprint) of the users that matched XIQ on the last run, a user
+    whose fingerprint and XIQ id are unchanged is skipped without comparing it.
+    """
+
+    def __init__(self, fingerprints=None):
+        self.ldap_users = {}
+        self.ldap_priority = {}
+        self.ldap_capture_success = True
+        self.ppsk_users = []
+        self.ppsk_by_name = {}
+        self.ppsk_by_id = {}
+        self.ppsk_by_group = {}
+        self.fingerprints = fingerprints or {}
+        # users found to match XIQ by diff(), in the fingerprints format
+        self.confirmed = {}
+        self.lock = threading.Lock()
+
+    def addLDAPUser(self, name, details, priority=0):
+        # When a user is in several AD groups the group listed first in group_roles (lowest priority) wins
+        with self.lock:
+            if name in self.ldap_users and self.ldap_priority[name] <= priority:
+                return False
+            self.ldap_users[name] = details
+            self.ldap_priority[name] = priority
+            return True
+
+    def addLDAPEntries(self, entries, xiq_user_role, priority=0):
+        for ldap_entry in entries:
+            if ldap_entry.name is None:
+                log_msg = (f"Unexpected error: attributes missing from {ldap_entry.entry_dn}")
+                logging.error(log_msg)
+                print(log_msg)
+                logging.warning("User info was not captured from Active Directory")
+                logging.warning(f"{ldap_entry}")
+                # not having ppsk will break later line - for name, details in ldap_users.items():
+                self.ldap_capture_success = False
+                continue
+            details = LDAPUser(ldap_entry.userAccountControl, ldap_entry.mail, ldap_entry.sAMAccountName, xiq_user_role, ldap_entry.objectGUID)
+            if not self.addLDAPUser(ldap_entry.name, details, priority):
+                logging.error(f"User {ldap_entry.name} has multiple entries. This entry will not be added to PPSK")
+                logging.warning(f"{ldap_entry}")
+
+    def addPPSKUsers(self, users):
+        with self.lock:
+            self.ppsk_users.extend(users)
+            for user in users:
+                self.ppsk_by_name.setdefault(user.user_name, user)
+                self.ppsk_by_id[user.id] = user
+                self.ppsk_by_group.setdefault((user.user_name, str(user.user_group_id)), user)
+
+    def diff(self):
+        # Returns the users to create in XIQ, the XIQ users to delete, the AD users that are disabled,
+        # the AD users skipped for not having an email, the (name, XIQ user) to update (email changed
+        # or AD user renamed, found by objectGUID) and the (name, XIQ user) to move to another group.
+        by_guid = {record[0]: (name, record[1]) for name, record in self.fingerprints.items() if record[0]}
+        creates = []
+        disabled = []
+        no_email = []
+        updates = []
+        moves = []
+        for name, details in self.ldap_users.items():
+            if details.email == '[]':
+                no_email.append(name)
+                continue
+            if accountDisabled(details.userAccountControl):
+                disabled.append(name)
+                continue
+            fingerprint = userFingerprint(details)
+            x = self.ppsk_by_group.get((name, str(details.xiq_role))) or self.ppsk_by_name.get(name)
+            if x is None:
+                old_name, xiq_id = by_guid.get(details.guid, (None, None))
+                x = self.ppsk_by_id.get(xiq_id)
+                if x is None or old_name in self.ldap_users:
+                    creates.append(name)
+                    continue
+            elif self.fingerprints.get(name) == (details.guid, x.id, fingerprint):
+                self.confirmed[name] = (details.guid, x.id, fingerprint)
+                continue
+            if str(x.user_group_id) != str(details.xiq_role):
+                moves.append((name, x))
+            elif x.email_address != details.email or x.user_name != name:
+                updates.append((name, x))
+            else:
+                self.confirmed[name] = (details.guid, x.id, fingerprint)
+        disabled_names = set(disabled)
+        changed = {x.id for name, x in updates + moves}
+        active_emails = {details.email for name, details in self.ldap_users.items() if name not in disabled_names}
+        deletes = [x for x in self.ppsk_users if x.email_address not in active_emails and x.id not in changed]
+        return creates, deletes, disabled, no_email, updates, moves
+
+
+def buildPCGIndex(PCGUsers):
+    # email -> (pcg user id, PCG_Maping entry). The first PCG user found for an email wins.
+    policy_by_group_name = {}
+    for PCG_Map in PCG_Maping.values():
+        policy_by_group_name[PCG_Map['UserGroupName']] = PCG_Map
+    pcg_index = {}
+    for PCGUser in PCGUsers:
+        if PCGUser.email in pcg_index:
+            continue
+        pcg_index[PCGUser.email] = (PCGUser.id, policy_by_group_name.get(PCGUser.user_group_name))
+    return pcg_index
+
+
+def syncCreateUser(name, details):
+    # Creates the PPSK user. Returns the PPSK error count and whether the user was created
+    ppsk_create_error = 0
+    user_created = False
+    try:
+        user_created = createPPSKuser(name, details.email, details.xiq_role)
+    except TypeError as e:
+        log_msg = f"failed to create {name}: {e}"
+        logging.error(log_msg)
+        print(log_msg)
+        ppsk_create_error+=1
+    except:
+        log_msg = f"Unknown Error: Failed to create user {name} - {details.email}"
+        logging.error(log_msg)
+        print(log_msg)
+        ppsk_create_error+=1
+    return ppsk_create_error, user_created
+
+
+def addUsersToPCGs(created_users, on_done=None):
+    # Adds the created (name, details) users to the PCG of their XIQ user group, batched per policy.
+    # on_done(name) is called for every user added. Returns the PCG error count
+    pcg_create_error = 0
+    pcg_adds = {}
+    for name, details in created_users:
+        if str(details.xiq_role) in PCG_Maping:
+            user_group_name = PCG_Maping[details.xiq_role]['UserGroupName']
+            pcg_adds.setdefault(details.xiq_role, []).append({"name": name, "email": details.email, "user_group_name": user_group_name})
+    results = runWriteTasks(lambda xiq_role, users: sendPCGBatches(addUserToPcg, PCG_Maping[xiq_role]['policy_id'], users), list(pcg_adds.items()))
+    for xiq_role, (succeeded, failed) in zip(pcg_adds, results):
+        policy_name = PCG_Maping[xiq_role]['policy_name']
+        for user in succeeded:
+            logging.info(f"User {user['name']} - was successfully add to pcg {policy_name}.")
+            if on_done is not None:
+                on_done(user['name'])
+        for user in failed:
+            log_msg = f"failed to add {user['name']} - {user['email']} to pcg {policy_name}"
             logging.error(log_msg)
             print(log_msg)
-            raise SystemExit     
+            pcg_create_error+=1
+    return pcg_create_error
+
+
+def planPCGDeletes(ppsk_deletes, pcg_index, pcg_capture_success):
+    # If PCG is Enabled, Users need to be deleted from PCG group before they can be deleted from User Group.
+    # Returns the XIQ users that can be deleted right away, the {policy_id: [(pcg_id, x, policy_name)]}
+    # PCG deletes to send first and the (PPSK, PCG) error counts for the users that can't be deleted.
+    ppsk_del_error = 0
+    pcg_del_error = 0
+    ready = []
+    pcg_deletes = {}
+    for x in ppsk_deletes:
+        email = x.email_address
+        if PCG_Enable == True and str(x.user_group_id) in PCG_Maping:
+            if pcg_capture_success == False:
+                log_msg = f"Due to PCG read failure, user {email} cannot be deleted"
+                logging.error(log_msg)
+                print(log_msg)
+                ppsk_del_error+=1
+                pcg_del_error+=1
+                continue
+            if email in pcg_index:
+                pcg_id, PCG_Map = pcg_index[email]
+                if PCG_Map is None:
+                    log_msg = f"User {email} - {pcg_id} is in a PCG user group that is not in PCG_Maping. User cannot be deleted from the PPSK Group."
+                    logging.error(log_msg)
+                    print(log_msg)
+                    ppsk_del_error+=1
+                    pcg_del_error+=1
+                    continue
+                pcg_deletes.setdefault(PCG_Map['policy_id'], []).append((pcg_id, x, PCG_Map['policy_name']))
+                continue
+        ready.append(x)
+    return ready, pcg_deletes, ppsk_del_error, pcg_del_error
+
+
+def sendPCGDeletes(pcg_deletes, on_done=None):
+    # Sends the PCG deletes batched per policy. on_done(pcg_id, x) is called for every user removed.
+    # Returns the error count for the users that can't be removed.
+    del_error = 0
+
+    def send(policy_id, chunk):
+        return deletePCGUsers(policy_id, [pcg_id for pcg_id, x, policy_name in chunk])
+
+    results = runWriteTasks(lambda policy_id, items: sendPCGBatches(send, policy_id, items), list(pcg_deletes.items()))
+    for succeeded, failed in results:
+        for pcg_id, x, policy_name in succeeded:
+            logging.info(f"User {x.email_address} - {pcg_id} was successfully deleted from pcg group {policy_name}.")
+            if on_done is not None:
+                on_done(pcg_id, x)
+        for pcg_id, x, policy_name in failed:
+            log_msg = f"Failed to delete user {x.email_address} - {pcg_id} from PCG group {policy_name}. User cannot be deleted from the PPSK Group."
+            logging.error(log_msg)
+            print(log_msg)
+            del_error+=1
+    return del_error
+
+
+def syncDeleteUser(x):
+    # Deletes the PPSK user. Returns the PPSK error count
+    email = x.email_address
+    result = ''
+    try:
+        result, userid = deleteUser(x.id)
+    except TypeError as e:
+        logmsg = f"Failed to delete user {email}  with error {e}"
+        logging.error(logmsg)
+        print(logmsg)
+        return 1
+    except:
+        log_msg = f"Unknown Error: Failed to delete user {email} "
+        logging.error(log_msg)
+        print(log_msg)
+        return 1
+    if result == 'Success':
+        logging.info(f"User {email} - {userid} was successfully deleted.")
+        return 0
+    log_msg = f"User {email} - {userid} did not successfully delete from the PPSK Group."
+    logging.info(log_msg)
+    print(log_msg)
+    return 1
+
+
+def syncUpdateUser(name, details, x):
+    # Updates the name and email of the XIQ user x from AD. Returns the PPSK error count
+    try:
+        updatePPSKUser(x.id, name, details.email, x.user_group_id)
+    except TypeError as e:
+        log_msg = f"Failed to update user {name} with error {e}"
+        logging.error(log_msg)
+        print(log_msg)
+        return 1
+    except:
+        log_msg = f"Unknown Error: Failed to update user {name} - {details.email}"
+        logging.error(log_msg)
+        print(log_msg)
+        return 1
+    if x.user_name != name:
+        log_msg = f"User {x.user_name} - {x.id} was renamed to {name} ({details.email})."
     else:
-        headers["Authorization"] = "Bearer " + XIQ_token
- 
-    ListOfADgroups, ListOfXIQUserGroups = zip(*group_roles)
+        log_msg = f"User {name} - {x.id} email was changed from {x.email_address} to {details.email}."
+    logging.info(log_msg)
+    return 0
+
+
+def runWriteTasks(func, items, label=None):
+    # Runs func(*item) for every item on a pool of threads of the calling write lane, with the workers of
+    # the lane, and returns the results in item order. With a label the progress of the items is reported
+    # under it.
+    if not items:
+        return []
+    lane = getattr(current_lane, 'lane', None)
+
+    def run(item):
+        current_lane.lane = lane
+        result = func(*item)
+        if label:
+            progress.advance(label)
+        return result
+
+    if label:
+        progress.start(label, len(items))
+    with ThreadPoolExecutor(max_workers=lane.workers) as executor:
+        results = list(executor.map(run, items))
+    if label:
+        progress.finish(label)
+    return results
+
 
-    # Collect PSK users
-    ppsk_users = []
-    for usergroupID in ListOfXIQUserGroups:
+def authenticate():
+    global token_manager
+    if 'XIQ_token' not in globals():
         try:
-            ppsk_users += retrievePPSKUsers(100,usergroupID)
+            if token_manager is None:
+                manager = TokenManager(XIQ_username, XIQ_password, XIQ_token_file)
+                manager.start()
+                token_manager = manager
+            else:
+                token_manager.ensureFresh()
         except TypeError as e:
             print(e)
-            print("script exiting....")
-            # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
             raise SystemExit
         except:
-            log_msg = ("Unknown Error: Failed to retrieve users from XIQ")
+            log_msg = "Unknown Error: Failed to generate token"
             logging.error(log_msg)
             print(log_msg)
-            print("script exiting....")
-            # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
-            raise SystemExit
-    log_msg = ("Successfully parsed " + str(len(ppsk_users)) + " XIQ users")
-    logging.info(log_msg)
-    print(f"{log_msg}\n")
-
-    # Collect LDAP Users
-    ldap_users = {}
-    ldap_capture_success = True
-    for ad_group, xiq_user_role in group_roles:
-        ad_result = retrieveADUsers(ad_group)
-        for ldap_entry in ad_result:
-            if str(ldap_entry.name) not in ldap_users:
-                try:
-                    ldap_users[str(ldap_entry.name)] = {
-                        "userAccountControl": str(ldap_entry.userAccountControl),
-                        "email": str(ldap_entry.mail),
-                        "username": str(ldap_entry.sAMAccountName),
-                        "xiq_role": xiq_user_role
-                    }
-                except:
-                    log_msg = (f"Unexpected error: {sys.exc_info()[0]}")
-                    logging.error(log_msg)
-                    print(log_msg)
-                    logging.warning("User info was not captured from Active Directory")
-                    logging.warning(f"{ldap_entry}")
-                    # not having ppsk will break later line - for name, details in ldap_users.items():
-                    ldap_capture_success = False
-                    continue
-            else:
-                logging.error(f"User {ldap_entry.name} has multiple entries. This entry will not be added to PPSK")
-                logging.warning(f"{ldap_entry}")
+            raise SystemExit     
+    else:
+        headers["Authorization"] = "Bearer " + XIQ_token
 
-    log_msg = "Successfully parsed " + str(len(ldap_users)) + " LDAP users"
-    logging.info(log_msg)
-    print(f"{log_msg}\n")
 
-    # Track Error counts
-    ppsk_create_error = 0
-    pcg_create_error = 0
-    ppsk_del_error = 0
-    pcg_del_error = 0
+def collectUsers():
+    # Collect PSK and LDAP users. All XIQ user groups and AD groups are read at the same time and
+    # every page goes straight into the user index. Returns the user index.
+    global ad_expander
+    ad_expander = GroupExpander()
+    ListOfADgroups, ListOfXIQUserGroups = zip(*group_roles)
+    user_index = UserIndex(loadFingerprints())
+    ldap_users = user_index.ldap_users
+    if AD_shards > 1:
+        # loaded before the group threads start, they all update it
+        loadADShards()
 
-    # Create PPSK Users
-    ldap_disabled = []
-    for name, details in ldap_users.items():
-        user_created = False
-        if details['email'] == '[]':
-            log_msg = (f"User {name} doesn't have an email set and will not be created in xiq")
-            logging.warning(log_msg)
-            print(log_msg)
-            continue
-        if not any(d['user_name'] == name for d in ppsk_users) and not any(d == details['userAccountControl'] for d in ldap_disable_codes):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=collect_workers) as executor:
+        ppsk_futures = [executor.submit(collectPPSKGroup, usergroupID, user_index.addPPSKUsers) for usergroupID in ListOfXIQUserGroups]
+        ad_state = None
+        if AD_incremental:
             try:
-                user_created = createPPSKuser(name, details["email"], details['xiq_role'])
-            except TypeError as e:
-                log_msg = f"failed to create {name}: {e}"
-                logging.error(log_msg)
-                print(log_msg)
-                ppsk_create_error+=1
+                ad_state = prepareADState()
             except:
-                log_msg = f"Unknown Error: Failed to create user {name} - {details['email']}"
+                log_msg = f"Unable to read the AD watermark from {server_name}"
                 logging.error(log_msg)
                 print(log_msg)
-                ppsk_create_error+=1
-            if PCG_Enable == True and user_created == True and str(details['xiq_role']) in PCG_Maping:
-                ## add user to PCG if PCG is Enabled
-                policy_id = PCG_Maping[details['xiq_role']]['policy_id']
-                policy_name = PCG_Maping[details['xiq_role']]['policy_name']
-                user_group_name = PCG_Maping[details['xiq_role']]['UserGroupName']
-                email = details["email"]
-                result = ''
-                try:
-                    result = addUserToPcg(policy_id, name, email, user_group_name)
-                except TypeError as e:
-                    log_msg = f"failed to add {name} to pcg {policy_name}: {e}"
-                    logging.error(log_msg)
-                    print(log_msg)
-                    pcg_create_error+=1
-                except:
-                    log_msg = f"Unknown Error: Failed to add user {name} - {details['email']} to pcg {policy_name}"
-                    logging.error(log_msg)
-                    print(log_msg)
-                    pcg_create_error+=1
-                if result == 'Success':
-                    log_msg = f"User {name} - was successfully add to pcg {policy_name}."
-                    logging.info(log_msg)
-                    print(log_msg)
-
-        elif any(d == details['userAccountControl'] for d in ldap_disable_codes):
-            ldap_disabled.append(name)
-    
-    # Remove disabled accounts from ldap users
-    for name in ldap_disabled:
-        logging.info(f"User {name} is is disabled in AD with disable code {ldap_users[name]['userAccountControl']}.")
-        del ldap_users[name]
-    
-    if PCG_Enable == True:
-        pcg_capture_success = True
-        # Collect PCG Users if PCG is Enabled
-        PCGUsers = []
-        for policy in PCG_Maping:
-            policy_id = PCG_Maping[policy]['policy_id']
+                print("script exiting....")
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise SystemExit
+        ldap_futures = []
+        for priority, (ad_group, xiq_user_role) in enumerate(group_roles):
+            on_page = lambda entries, xiq_user_role=xiq_user_role, priority=priority: user_index.addLDAPEntries(entries, xiq_user_role, priority)
+            ldap_futures.append(executor.submit(collectADGroup, ad_group, on_page, ad_state))
 
+        for future in ppsk_futures:
             try:
-                PCGUsers += retrievePCGUsers(policy_id)
+                future.result()
             except TypeError as e:
                 print(e)
-                pcg_capture_success = False
+                print("script exiting....")
                 # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise SystemExit
             except:
                 log_msg = ("Unknown Error: Failed to retrieve users from XIQ")
                 logging.error(log_msg)
                 print(log_msg)
-                pcg_capture_success = False
+                print("script exiting....")
                 # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
-
-        log_msg = "Successfully parsed " + str(len(PCGUsers)) + " PCG users"
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise SystemExit
+        run_metrics.recordPhase('xiq_collect', time.perf_counter() - started, len(user_index.ppsk_users))
+        progress.finish("XIQ users", report=False)
+        log_msg = ("Successfully parsed " + str(len(user_index.ppsk_users)) + " XIQ users")
         logging.info(log_msg)
         print(f"{log_msg}\n")
 
-    if ldap_capture_success:
-        for x in ppsk_users:
-            user_group_id = x['user_group_id']
-            email = x['email_address']
-            xiq_id = x['id']
-            # check if any xiq user is not included in active ldap users
-            if not any(d['email'] == email for d in ldap_users.values()):
-                if PCG_Enable == True and str(user_group_id) in PCG_Maping:
-                    if pcg_capture_success == False:
-                        log_msg = f"Due to PCG read failure, user {email} cannot be deleted"
-                        logging.error(log_msg)
-                        print(log_msg)
-                        ppsk_del_error+=1
-                        pcg_del_error+=1
-                        continue
-                # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
-                    # If PCG is Enabled, Users need to be deleted from PCG group before they can be deleted from User Group
-                    if any(d['email'] == email for d in PCGUsers):
-                        # Find specific PCG user and get the user id
-                        PCGUser = (list(filter(lambda PCGUser: PCGUser['email'] == email, PCGUsers)))[0]
-                        pcg_id = PCGUser['id']
-                        for PCG_Map in PCG_Maping.values():
-                            if PCG_Map['UserGroupName'] == PCGUser['user_group_name']:
-                                policy_id = PCG_Map['policy_id']
-                                policy_name = PCG_Map['policy_name']
-                        result = ''
-                        try:
-                            result = deletePCGUsers(policy_id, pcg_id)
-                        except TypeError as e:
-                            logmsg = f"Failed to delete user {email} from PCG group {policy_name} with error {e}"
-                            logging.error(logmsg)
-                            print(logmsg)
-                            ppsk_del_error+=1
-                            pcg_del_error+=1
-                            continue
-                        except:
-                            log_msg = f"Unknown Error: Failed to delete user {email} from pcg group {policy_name}"
-                            logging.error(log_msg)
-                            print(log_msg)
-                            ppsk_del_error+=1
-                            pcg_del_error+=1
-                            continue
-                        if result == 'Success':
-                            log_msg = f"User {email} - {pcg_id} was successfully deleted from pcg group {policy_name}."
-                            logging.info(log_msg)
-                            print(log_msg)
-                        else:
-                            log_msg = f"User {email} - {pcg_id} was not successfully deleted from pcg group {policy_name}. User cannot be deleted from the PPSK Group."
-                            logging.info(log_msg)
-                            print(log_msg)
-                            ppsk_del_error+=1
-                            pcg_del_error+=1 
-                            continue
-                result = ''
+        for future in ldap_futures:
+            try:
+                future.result()
+            except SystemExit:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    run_metrics.recordPhase('ad_collect', time.perf_counter() - started, len(ldap_users))
+    progress.finish("AD users", report=False)
+    if ad_state is not None and user_index.ldap_capture_success:
+        ad_state['usn'] = ad_state['new_usn']
+        saveADState(ad_state)
+    if AD_shards > 1:
+        saveADShards()
+
+    log_msg = "Successfully parsed " + str(len(ldap_users)) + " LDAP users"
+    logging.info(log_msg)
+    print(f"{log_msg}\n")
+    return user_index
+
+
+def collectPCGIndex():
+    # Collect PCG Users if PCG is Enabled. Returns the PCG index and whether every policy was read
+    pcg_index = {}
+    pcg_capture_success = True
+    if PCG_Enable == True:
+        started = time.perf_counter()
+        PCGUsers = []
+        # every policy is read once, at the same time
+        policy_ids = list(dict.fromkeys(PCG_Map['policy_id'] for PCG_Map in PCG_Maping.values()))
+        with ThreadPoolExecutor(max_workers=collect_workers) as executor:
+            futures = [executor.submit(collectPCGUsers, policy_id) for policy_id in policy_ids]
+            for future in futures:
                 try:
-                    result, userid = deleteUser(xiq_id)
+                    PCGUsers.extend(future.result())
                 except TypeError as e:
-                    logmsg = f"Failed to delete user {email}  with error {e}"
-                    logging.error(logmsg)
-                    print(logmsg)
-                    ppsk_del_error+=1
-                    continue
+                    print(e)
+                    pcg_capture_success = False
+                    # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
                 except:
-                    log_msg = f"Unknown Error: Failed to delete user {email} "
+                    log_msg = ("Unknown Error: Failed to retrieve users from XIQ")
                     logging.error(log_msg)
                     print(log_msg)
-                    ppsk_del_error+=1
-                    continue
-                if result == 'Success':
-                    log_msg = f"User {email} - {userid} was successfully deleted."
-                    logging.info(log_msg)
-                    print(log_msg)
-                else:
-                    log_msg = f"User {email} - {userid} did not successfully delete from the PPSK Group."
-                    logging.info(log_msg)
-                    print(log_msg)
-                    ppsk_del_error+=1
+                    pcg_capture_success = False
+                    # not having ppsk will break later line - if not any(d['name'] == name for d in ppsk_users):
 
-        if ppsk_create_error:
-            log_msg = f"There were {ppsk_create_error} errors creating PPSK users on this run."
-            logging.info(log_msg)
-            print(log_msg)
-        if pcg_create_error:
-            log_msg = f"There were {pcg_create_error} errors creating PCG users on this run."
-            logging.info(log_msg)
-            print(log_msg)
-        if ppsk_del_error:
-            log_msg = f"There were {ppsk_del_error} errors deleting PPSK users on this run."
-            logging.info(log_msg)
-            print(log_msg)
-        if pcg_del_error:
-            log_msg = f"There were {pcg_del_error} errors deleting PCG users on this run."
-            logging.info(log_msg)
-            print(log_msg)
+        run_metrics.recordPhase('pcg_collect', time.perf_counter() - started, len(PCGUsers))
+        log_msg = "Successfully parsed " + str(len(PCGUsers)) + " PCG users"
+        logging.info(log_msg)
+        print(f"{log_msg}\n")
+        pcg_index = buildPCGIndex(PCGUsers)
+    return pcg_index, pcg_capture_success
+
+
+def reconcileUsers(user_index):
+    # Returns the (creates, deletes, disabled, updates, moves) of the user index and logs the users
+    # without an email and the disabled users
+    ldap_users = user_index.ldap_users
+    with run_metrics.phase('reconcile'):
+        ldap_creates, ppsk_deletes, ldap_disabled, ldap_no_email, ppsk_updates, ppsk_moves = user_index.diff()
+    run_metrics.countItems('reconcile', len(ldap_users) + len(user_index.ppsk_users))
+    run_metrics.setCounter('ldap_disabled', len(ldap_disabled))
+    run_metrics.setCounter('ldap_no_email', len(ldap_no_email))
+    run_metrics.setCounter('ldap_unchanged', len(user_index.confirmed))
+    for name in ldap_no_email:
+        log_msg = (f"User {name} doesn't have an email set and will not be created in xiq")
+        logging.warning(log_msg)
+        print(log_msg)
+    for name in ldap_disabled:
+        logging.info(f"User {name} is is disabled in AD with disable code {ldap_users[name].userAccountControl}.")
+    return ldap_creates, ppsk_deletes, ldap_disabled, ppsk_updates, ppsk_moves
+
+
+def loadFingerprints():
+    if xiq_store is not None:
+        return xiq_store.fingerprints()
+    return dict(user_fingerprints)
 
+
+def saveFingerprints(user_index, ops, done):
+    # Keeps the fingerprints of the users that matched XIQ and of the users updated on this run
+    global user_fingerprints
+    fingerprints = dict(user_index.confirmed)
+    for index in done:
+        op = ops[index]
+        if op['op'] == 'update':
+            details = LDAPUser(*op['user'])
+            fingerprints[op['name']] = (details.guid, op['xiq'][0], userFingerprint(details))
+    if xiq_store is not None:
+        xiq_store.replaceFingerprints(fingerprints)
     else:
+        user_fingerprints = fingerprints
+
+
+def logErrorCounts(errors):
+    if errors['ppsk_create_error']:
+        log_msg = f"There were {errors['ppsk_create_error']} errors creating PPSK users on this run."
+        logging.info(log_msg)
+        print(log_msg)
+    if errors['pcg_create_error']:
+        log_msg = f"There were {errors['pcg_create_error']} errors creating PCG users on this run."
+        logging.info(log_msg)
+        print(log_msg)
+    if errors['ppsk_update_error']:
+        log_msg = f"There were {errors['ppsk_update_error']} errors updating PPSK users on this run."
+        logging.info(log_msg)
+        print(log_msg)
+    if errors['ppsk_del_error']:
+        log_msg = f"There were {errors['ppsk_del_error']} errors deleting PPSK users on this run."
+        logging.info(log_msg)
+        print(log_msg)
+    if errors['pcg_del_error']:
+        log_msg = f"There were {errors['pcg_del_error']} errors deleting PCG users on this run."
+        logging.info(log_msg)
+        print(log_msg)
+    for name, value in errors.items():
+        run_metrics.setCounter(name, value)
+
+
+# A sync is a list of operations, each a dict with the op type and what it needs to run:
+#   create     {name, user}                           create the PPSK user (LDAPUser fields)
+#   pcg_add    {name, user}                           add the PPSK user to the PCG of its user group
+#   pcg_delete {pcg_id, policy_id, policy_name, user} remove the XIQ user (XIQUser fields) from a PCG
+#   delete     {user}                                 delete the XIQ user
+#   update     {name, user, xiq}                      rename the XIQ user and/or change its email
+# 'after' is the index of an operation that has to be done first. A user moved to another user group
+# is deleted and created again (XIQ can't change the group of an end user), so that create is after
+# the delete.
+def buildOperations(user_index, creates, deletes, updates, moves, pcg_index, pcg_capture_success):
+    # Returns the operations and the error counts of the users that can't be deleted or updated
+    ldap_users = user_index.ldap_users
+    ops = []
+
+    def add(op):
+        ops.append(op)
+        return len(ops) - 1
+
+    def pcgMapped(xiq_role):
+        return PCG_Enable == True and str(xiq_role) in PCG_Maping
+
+    for name in creates:
+        index = add({"op": "create", "lane": "create", "name": name, "user": list(ldap_users[name])})
+        if pcgMapped(ldap_users[name].xiq_role):
+            add({"op": "pcg_add", "lane": "create", "name": name, "user": list(ldap_users[name]), "after": index})
+
+    # deleted and moved users leave their PCG, and so do updated users whose email changes
+    email_changes = [x for name, x in updates if x.email_address != ldap_users[name].email]
+    leaving = deletes + [x for name, x in moves] + email_changes
+    ready, pcg_deletes, ppsk_del_error, pcg_del_error = planPCGDeletes(leaving, pcg_index, pcg_capture_success)
+    pcg_removals = {}
+    removed = set(x.id for x in deletes)
+    for policy_id, items in pcg_deletes.items():
+        for pcg_id, x, policy_name in items:
+            pcg_removals[x.id] = add({"op": "pcg_delete", "lane": "remove" if x.id in removed else "modify", "pcg_id": pcg_id, "policy_id": policy_id, "policy_name": policy_name, "user": list(x)})
+    # users that can't leave their PCG are left alone
+    blocked = set(x.id for x in leaving) - set(x.id for x in ready) - set(pcg_removals)
+
+    def afterPCG(op, x):
+        if x.id in pcg_removals:
+            op['after'] = pcg_removals[x.id]
+        return add(op)
+
+    for x in deletes:
+        if x.id not in blocked:
+            afterPCG({"op": "delete", "lane": "remove", "user": list(x)}, x)
+    # an updated user missing from its PCG under its new email is added back, also when it left the PCG
+    # on an earlier run whose update failed
+    for name, x in updates:
+        if x.id not in blocked:
+            index = afterPCG({"op": "update", "lane": "modify", "name": name, "user": list(ldap_users[name]), "xiq": list(x)}, x)
+            if pcgMapped(ldap_users[name].xiq_role) and pcg_capture_success != False and ldap_users[name].email not in pcg_index:
+                add({"op": "pcg_add", "lane": "modify", "name": name, "user": list(ldap_users[name]), "after": index})
+    # a moved user stays in the modify lane throughout, so it isn't left without a PPSK behind the creates
+    for name, x in moves:
+        if x.id not in blocked:
+            index = afterPCG({"op": "delete", "lane": "modify", "user": list(x)}, x)
+            index = add({"op": "create", "lane": "modify", "name": name, "user": list(ldap_users[name]), "after": index})
+            if pcgMapped(ldap_users[name].xiq_role):
+                add({"op": "pcg_add", "lane": "modify", "name": name, "user": list(ldap_users[name]), "after": index})
+    return ops, ppsk_del_error, pcg_del_error
+
+
+class WriteLane:
+    """A priority lane of the write scheduler, with its own workers and XIQ request budget."""
+
+    def __init__(self, name, priority, workers, rate):
+        self.name = name
+        self.priority = priority
+        self.workers = max(workers, 1)
+        self.limiter = TokenBucket(rate, self.workers)
+        # operations ready to run, and the operations of the lane not finished yet (ready or waiting)
+        self.ready = []
+        self.open = 0
+
+
+def laneOf(op):
+    # plans written before the lanes existed have no lane in their operations
+    return op.get('lane') or {'pcg_delete': 'remove', 'delete': 'remove', 'update': 'modify'}.get(op['op'], 'create')
+
+
+def applyOperations(ops, done=None, mark=None, detected=None):
+    # Runs the operations that are not in done, each once its 'after' operation is done, in the write
+    # lanes. Every lane runs on its own thread and takes the operations ready in it in batches, by op type
+    # in the order below so PCG calls stay batched. mark(index) is called for every operation done and
+    # detected is when the changes were found (default now). Returns the error counts.
+    if done is None:
+        done = set()
+    if mark is None:
+        mark = done.add
+    if detected is None:
+        detected = time.time()
+    errors = {'ppsk_create_error': 0, 'pcg_create_error': 0, 'ppsk_update_error': 0, 'ppsk_del_error': 0, 'pcg_del_error': 0}
+    op_types = [('pcg_delete', 'pcg_delete'), ('delete', 'ppsk_delete'), ('update', 'ppsk_update'), ('create', 'ppsk_create'), ('pcg_add', 'pcg_add')]
+    lanes = {name: WriteLane(name, priority, *write_lanes[name]) for priority, name in enumerate(['remove', 'modify', 'create'])}
+    # index -> indexes of the operations waiting for it
+    dependents = {}
+    condition = threading.Condition()
+    aborted = []
+    for index, op in enumerate(ops):
+        if index in done:
+            continue
+        lanes[laneOf(op)].open += 1
+        if 'after' in op and op['after'] not in done:
+            dependents.setdefault(op['after'], []).append(index)
+        else:
+            lanes[laneOf(op)].ready.append(index)
+
+    def drop(indexes):
+        # operations whose 'after' operation failed are not run
+        for index in indexes:
+            lanes[laneOf(ops[index])].open -= 1
+            drop(dependents.pop(index, []))
+
+    def finish(index, succeeded):
+        with condition:
+            lane = lanes[laneOf(ops[index])]
+            lane.open -= 1
+            if succeeded:
+                mark(index)
+                run_metrics.observeApplied(lane.name, time.time() - detected)
+                for dependent in dependents.pop(index, []):
+                    lanes[laneOf(ops[dependent])].ready.append(dependent)
+            else:
+                drop(dependents.pop(index, []))
+            condition.notify_all()
+
+    def count(key, value):
+        with condition:
+            errors[key] += value
+
+    # end user calls are finished one by one as they return, so their latency is their own
+    def create(index, name, details):
+        ppsk_error, user_created = syncCreateUser(name, details)
+        count('ppsk_create_error', ppsk_error)
+        finish(index, user_created == True)
+
+    def delete(index, x):
+        result = syncDeleteUser(x)
+        count('ppsk_del_error', result)
+        finish(index, result == 0)
+
+    def update(index, name, details, x):
+        result = syncUpdateUser(name, details, x)
+        count('ppsk_update_error', result)
+        finish(index, result == 0)
+
+    def runBatch(op_type, batch, lane):
+        if op_type == 'create':
+            runWriteTasks(create, [(index, op['name'], LDAPUser(*op['user'])) for index, op in batch], f"PPSK users created ({lane.name})")
+        elif op_type == 'pcg_add':
+            by_name = {op['name']: index for index, op in batch}
+            added = set()
+            count('pcg_create_error', addUsersToPCGs([(op['name'], LDAPUser(*op['user'])) for index, op in batch], on_done=lambda name: added.add(by_name[name])))
+            for index, op in batch:
+                finish(index, index in added)
+        elif op_type == 'pcg_delete':
+            by_pcg_id = {op['pcg_id']: index for index, op in batch}
+            pcg_deletes = {}
+            for index, op in batch:
+                pcg_deletes.setdefault(op['policy_id'], []).append((op['pcg_id'], XIQUser(*op['user']), op['policy_name']))
+            removed = set()
+            count('pcg_del_error', sendPCGDeletes(pcg_deletes, on_done=lambda pcg_id, x: removed.add(by_pcg_id[pcg_id])))
+            for index, op in batch:
+                if index not in removed:
+                    # the delete, update or move waiting for the removal won't run
+                    count('ppsk_del_error' if laneOf(op) == 'remove' else 'ppsk_update_error', 1)
+                finish(index, index in removed)
+        elif op_type == 'delete':
+            runWriteTasks(delete, [(index, XIQUser(*op['user'])) for index, op in batch], f"PPSK users deleted ({lane.name})")
+        elif op_type == 'update':
+            runWriteTasks(update, [(index, op['name'], LDAPUser(*op['user']), XIQUser(*op['xiq'])) for index, op in batch], f"PPSK users updated ({lane.name})")
+
+    def runLane(lane):
+        current_lane.lane = lane
+        try:
+            while True:
+                with condition:
+                    while not lane.ready and lane.open and not aborted:
+                        condition.wait()
+                    if not lane.ready or aborted:
+                        return
+                    ready = sorted(lane.ready)
+                    lane.ready = []
+                for op_type, phase in op_types:
+                    batch = [(index, ops[index]) for index in ready if ops[index]['op'] == op_type]
+                    if not batch:
+                        continue
+                    started = time.perf_counter()
+                    runBatch(op_type, batch, lane)
+                    run_metrics.recordPhase(phase, time.perf_counter() - started, len(batch))
+        except BaseException:
+            # the other lanes stop too instead of waiting for operations this lane won't run
+            with condition:
+                aborted.append(lane.name)
+                condition.notify_all()
+            raise
+        finally:
+            current_lane.lane = None
+
+    with ThreadPoolExecutor(max_workers=len(lanes), thread_name_prefix='lane') as executor:
+        futures = [executor.submit(runLane, lane) for lane in lanes.values() if lane.open]
+        for future in futures:
+            future.result()
+    for lane, latency in run_metrics.laneLatency().items():
+        log_msg = (f"{lane} lane: {latency['applied']} changes applied, detection to applied {latency['p50']:.1f}s median, "
+                   f"{latency['p95']:.1f}s p95, {latency['max']:.1f}s max")
+        logging.info(log_msg)
+        print(log_msg)
+    return errors
+
+
+def startRun():
+    # Fresh API counters, run metrics and progress for a run
+    global run_metrics
+    api_stats.clear()
+    run_metrics = RunMetrics()
+    progress.reset()
+
+
+def main():
+    global xiq_store
+    startRun()
+    authenticate()
+
+    if XIQ_state_store and xiq_store is None:
+        xiq_store = XIQStateStore(XIQ_state_db)
+
+    user_index = collectUsers()
+    ldap_capture_success = user_index.ldap_capture_success
+    ldap_creates, ppsk_deletes, ldap_disabled, ppsk_updates, ppsk_moves = reconcileUsers(user_index)
+    detected = time.time()
+    if not ldap_capture_success:
         log_msg = "No users will be deleted from XIQ because of the error(s) in reading ldap users"
         logging.warning(log_msg)
         print(log_msg)
+        ppsk_deletes = []
+        ppsk_moves = []
+    pcg_index, pcg_capture_success = collectPCGIndex()
+
+    ops, ppsk_del_error, pcg_del_error = buildOperations(user_index, ldap_creates, ppsk_deletes, ppsk_updates, ppsk_moves, pcg_index, pcg_capture_success)
+    done = set()
+    errors = applyOperations(ops, done, detected=detected)
+    errors['ppsk_del_error'] += ppsk_del_error
+    errors['pcg_del_error'] += pcg_del_error
+    saveFingerprints(user_index, ops, done)
+
+    logErrorCounts(errors)
+    logApiStats()
+
+
+# Plan files are JSON lines: a header line followed by one operation per line (see buildOperations).
+# Progress is appended to '<plan file>.progress' as the index of every operation done, so an apply
+# that stopped part way resumes from there when it is run again.
+def writePlan(plan_file):
+    # Reads AD and XIQ and writes the changes a sync would make to plan_file without making them
+    global xiq_store
+    startRun()
+    authenticate()
+
+    if XIQ_state_store and xiq_store is None:
+        xiq_store = XIQStateStore(XIQ_state_db)
+
+    user_index = collectUsers()
+    ldap_creates, ppsk_deletes, ldap_disabled, ppsk_updates, ppsk_moves = reconcileUsers(user_index)
+    detected = time.time()
+    if not user_index.ldap_capture_success:
+        log_msg = "No users will be deleted from XIQ because of the error(s) in reading ldap users"
+        logging.warning(log_msg)
+        print(log_msg)
+        ppsk_deletes = []
+        ppsk_moves = []
+    pcg_index, pcg_capture_success = collectPCGIndex()
+    ops, ppsk_del_error, pcg_del_error = buildOperations(user_index, ldap_creates, ppsk_deletes, ppsk_updates, ppsk_moves, pcg_index, pcg_capture_success)
+
+    header = {"plan": f"{time.time():.6f}-{os.getpid()}", "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "detected": detected, "operations": len(ops)}
+    lines = [json.dumps(header, separators=(',', ':'))]
+    lines.extend(json.dumps(op, separators=(',', ':')) for op in ops)
+    writeFileAtomic(plan_file, "\n".join(lines) + "\n")
+    counts = {}
+    for op in ops:
+        counts[op['op']] = counts.get(op['op'], 0) + 1
+    log_msg = f"Wrote plan {plan_file}: " + ", ".join(f"{counts.get(op, 0)} {op}" for op in ['create', 'pcg_add', 'pcg_delete', 'delete', 'update'])
+    logging.info(log_msg)
+    print(log_msg)
+    if ppsk_del_error:
+        log_msg = f"{ppsk_del_error} PPSK users cannot be deleted and were left out of the plan."
+        logging.warning(log_msg)
+        print(log_msg)
+    run_metrics.setCounter('plan_operations', len(ops))
+    logApiStats()
+
+
+class PlanProgress:
+    # Records the index of every plan operation done in an append only progress file
+    def __init__(self, path, plan_id):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        if lines and lines[0] == plan_id:
+            for line in lines[1:]:
+                if line.isdigit():
+                    self.done.add(int(line))
+            self.file = open(path, 'a')
+        else:
+            # no progress yet, or progress of an older plan written to the same path
+            self.file = open(path, 'w')
+            self.file.write(plan_id + "\n")
+            self.file.flush()
+
+    def mark(self, index):
+        with self.lock:
+            self.done.add(index)
+            self.file.write(f"{index}\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def applyPlan(plan_file):
+    # Applies the operations of a plan written by writePlan(), skipping the ones already done
+    global xiq_store
+    startRun()
+    try:
+        with open(plan_file) as f:
+            header = json.loads(f.readline())
+            ops = [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError) as e:
+        log_msg = f"Unable to read plan {plan_file}: {e}"
+        logging.error(log_msg)
+        print(log_msg)
+        raise SystemExit
+    authenticate()
+
+    if XIQ_state_store and xiq_store is None:
+        xiq_store = XIQStateStore(XIQ_state_db)
+
+    progress = PlanProgress(plan_file + '.progress', header['plan'])
+    done = progress.done
+    if done:
+        log_msg = f"Resuming plan {plan_file}, {len(done)} of {len(ops)} operations already done"
+        logging.info(log_msg)
+        print(log_msg)
+
+    try:
+        errors = applyOperations(ops, done, progress.mark, header.get('detected'))
+    finally:
+        progress.close()
+
+    logErrorCounts(errors)
+    remaining = len(ops) - len(done)
+    run_metrics.setCounter('plan_remaining', remaining)
+    if remaining:
+        log_msg = f"{remaining} of {len(ops)} operations of plan {plan_file} were not applied, run --apply again to retry them"
+        logging.warning(log_msg)
+    else:
+        log_msg = f"Plan {plan_file} was fully applied"
+        logging.info(log_msg)
+    print(log_msg)
+    logApiStats()
+
+
+@contextmanager
+def syncLock():
+    # Yields False when another sync (daemon cycle or cron run) holds the lock file
+    with open(lock_file, 'a') as f:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def runOnce(run=main):
+    with syncLock() as acquired:
+        if not acquired:
+            log_msg = "Another sync is still running, exiting"
+            logging.warning(log_msg)
+            print(log_msg)
+            raise SystemExit
+        status = "failed"
+        try:
+            run()
+            status = "success"
+        finally:
+            writeRunReport(status)
+            closeConnections()
+
+
+def runDaemon():
+    # Runs main() every sync_interval seconds (plus up to sync_jitter seconds) in one process so the
+    # HTTP session, AD connections and state are reused. A cycle that overruns the interval delays
+    # the next one, cycles never overlap.
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    log_msg = f"Starting sync daemon, running every {sync_interval}s"
+    logging.info(log_msg)
+    print(log_msg)
+    while not stop.is_set():
+        started = time.monotonic()
+        with syncLock() as acquired:
+            if not acquired:
+                logging.warning("Another sync is still running, skipping this cycle")
+            else:
+                status = "failed"
+                try:
+                    main()
+                    status = "success"
+                except SystemExit:
+                    logging.error("Sync cycle was aborted, retrying on the next cycle")
+                except Exception:
+                    logging.exception("Unknown Error: sync cycle failed, retrying on the next cycle")
+                writeRunReport(status)
+        delay = max(0, sync_interval - (time.monotonic() - started)) + random.uniform(0, sync_jitter)
+        stop.wait(delay)
+    closeConnections()
+    logging.info("Sync daemon stopped")
+
+
+def closeConnections():
+    if ad_pool is not None:
+        ad_pool.close()
+    if xiq_store is not None:
+        xiq_store.close()
+    session.close()
+
+
+# Settings at the top of this script a tenant of the tenants file can set. The settings of the runner
+# itself (tenant_workers, global_api_calls, tenant_timeout, ...) and the log file are not among them.
+tenant_settings = {
+    'server_name', 'domain_name', 'user_name', 'password', 'page', 'AD_Filter', 'AD_exclude_disabled',
+    'AD_nested_groups', 'AD_group_expansion', 'AD_servers', 'AD_discover_dcs', 'AD_connect_timeout',
+    'AD_dc_retry', 'AD_connections', 'AD_schema_info', 'AD_shards', 'AD_reconnect_attempts', 'AD_incremental',
+    'AD_full_resync_hours', 'XIQ_username', 'XIQ_password', 'XIQ_token', 'group_roles', 'PCG_Enable',
+    'PCG_Maping', 'tenant_api_calls', 'collect_workers', 'write_lanes', 'pcg_batch_size', 'XIQ_state_store',
+    'XIQ_verify_hours', 'XIQ_timeout', 'XIQ_max_retries', 'XIQ_backoff_base', 'XIQ_backoff_max',
+    'XIQ_rate_limit', 'XIQ_rate_burst', 'XIQ_page_size', 'XIQ_page_workers', 'XIQ_pcg_page_size',
+    'log_max_bytes', 'log_backups', 'log_json', 'progress_interval', 'AD_state_file', 'AD_shard_file',
+    'AD_tuning_file', 'XIQ_state_db', 'metrics_json_file', 'metrics_prom_file', 'lock_file',
+    'XIQ_token_file', 'XIQ_token_refresh', 'URL'
+}
+
+
+def configureTenant(tenant):
+    # Applies a tenant of the tenants file to the settings at the top of this script. Every tenant gets
+    # its own log, state, lock, token and report files, named after the tenant.
+    global rate_limiter, XIQ_token
+    name = tenant['name']
+    settings = {
+        'AD_state_file': '{}/XIQ-AD-PPSK-ad-state-{}.json'.format(PATH, name),
+        'AD_shard_file': '{}/XIQ-AD-PPSK-ad-shards-{}.json'.format(PATH, name),
+        'XIQ_state_db': '{}/XIQ-AD-PPSK-state-{}.db'.format(PATH, name),
+        'metrics_json_file': '{}/XIQ-AD-PPSK-metrics-{}.json'.format(PATH, name),
+        'metrics_prom_file': '',
+        'lock_file': '{}/XIQ-AD-PPSK-sync-{}.lock'.format(PATH, name),
+        'XIQ_token_file': '{}/XIQ-AD-PPSK-token-{}.json'.format(PATH, name),
+        'AD_tuning_file': '{}/XIQ-AD-PPSK-ad-tuning-{}.json'.format(PATH, name)
+    }
+    for key, value in tenant.items():
+        if key == 'name':
+            continue
+        if key not in tenant_settings:
+            raise ValueError(f"unknown setting {key}")
+        settings[key] = value
+    if 'group_roles' in settings:
+        settings['group_roles'] = [tuple(group_role) for group_role in settings['group_roles']]
+    # settings of the tenant itself win over its tuning report
+    for key, value in loadADTuning(settings['AD_tuning_file']).items():
+        settings.setdefault(key, value)
+    if 'XIQ_username' in settings and 'XIQ_token' not in settings:
+        del XIQ_token
+    globals().update(settings)
+    rate_limiter = TokenBucket(XIQ_rate_limit, XIQ_rate_burst)
+    setupLogging('{}/XIQ-AD-PPSK-sync-{}.log'.format(PATH, name))
+
+
+def runTenant(tenant, global_slots, held, results):
+    # Worker process of the multi-tenant runner. Output goes to the tenant log, the result to results.
+    global api_slots, global_api_slots, global_api_held
+    started = time.time()
+    result = {"tenant": tenant['name'], "status": "failed", "error": None}
+    sys.stdout = open(os.devnull, 'w')
+    signal.signal(signal.SIGTERM, stopTenant)
+    try:
+        configureTenant(tenant)
+        api_slots = threading.BoundedSemaphore(tenant_api_calls)
+        global_api_slots = global_slots
+        global_api_held = held
+        runOnce()
+        result['status'] = "success"
+    except SystemExit:
+        if tenant_stopping.is_set():
+            # the runner already failed the tenant
+            return
+        result['error'] = "sync aborted, see the tenant log"
+    except BaseException as e:
+        logging.exception("Unknown Error: tenant sync failed")
+        result['error'] = f"{e.__class__.__name__}: {e}"
+    result['seconds'] = time.time() - started
+    result['report'] = run_metrics.report(result['status'])
+    results.put(result)
+
+
+def runTenants(tenants_file):
+    # Syncs every tenant of tenants_file (a JSON list of setting overrides with a unique name) in
+    # tenant_workers processes at a time. A failing, crashing or hanging tenant only fails itself.
+    try:
+        with open(tenants_file) as f:
+            tenants = json.load(f)
+        names = [tenant['name'] for tenant in tenants]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log_msg = f"Unable to read tenants from {tenants_file}: {e}"
+        logging.error(log_msg)
+        print(log_msg)
+        raise SystemExit
+    invalid = [name for name in names if not isinstance(name, str) or not re.fullmatch(r'[\w.-]+', name)]
+    if invalid or len(set(names)) != len(names):
+        log_msg = f"Tenant names must be unique and only use letters, digits, '.', '_' and '-': {invalid or names}"
+        logging.error(log_msg)
+        print(log_msg)
+        raise SystemExit
+
+    context = multiprocessing.get_context('spawn')
+    # every tenant process counts the global slots it holds. A tenant stopped at tenant_timeout gives its
+    # slots back itself, the slots of a process that crashed or had to be killed are given back from that count
+    global_slots = context.BoundedSemaphore(global_api_calls)
+
+    def reclaimSlots(name, held):
+        # read without the lock of the count, the killed process may have died holding it
+        count = held.get_obj().value
+        for i in range(count):
+            try:
+                global_slots.release()
+            except ValueError:
+                # already back at global_api_calls
+                break
+        if count:
+            logging.warning(f"Gave back {count} XIQ request slots held by tenant {name}")
+
+    results_queue = context.Queue()
+    started = time.time()
+    pending = list(tenants)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < tenant_workers:
+            tenant = pending.pop(0)
+            held = context.Value('i', 0, lock=True)
+            process = context.Process(target=runTenant, args=(tenant, global_slots, held, results_queue), name=f"tenant-{tenant['name']}")
+            process.start()
+            running[tenant['name']] = (process, time.monotonic(), held)
+            print(f"Started sync of tenant {tenant['name']}")
+        try:
+            result = results_queue.get(timeout=1)
+            results[result['tenant']] = result
+            print(f"Tenant {result['tenant']}: {result['status']} in {result['seconds']:.1f}s" + (f" - {result['error']}" if result['error'] else ""))
+        except queue.Empty:
+            pass
+        for name, (process, process_started, held) in list(running.items()):
+            if name in results:
+                process.join()
+                del running[name]
+            elif not process.is_alive():
+                # exited without a result, so it crashed
+                process.join()
+                reclaimSlots(name, held)
+                results[name] = {"tenant": name, "status": "failed", "error": f"worker exited with code {process.exitcode}", "seconds": time.monotonic() - process_started}
+                print(f"Tenant {name}: failed - {results[name]['error']}")
+                del running[name]
+            elif time.monotonic() - process_started > tenant_timeout:
+                process.terminate()
+                process.join(tenant_stop_timeout)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+                reclaimSlots(name, held)
+                results[name] = {"tenant": name, "status": "failed", "error": f"stopped after {tenant_timeout}s", "seconds": time.monotonic() - process_started}
+                print(f"Tenant {name}: failed - {results[name]['error']}")
+                del running[name]
+
+    totals = {"tenants": len(tenants), "success": 0, "failed": 0, "xiq_requests": 0, "xiq_retries": 0, "tenant_seconds": 0.0}
+    for result in results.values():
+        totals[result['status']] += 1
+        totals['tenant_seconds'] += result['seconds']
+        for histogram in result.get('report', {}).get('http', {}).values():
+            totals['xiq_requests'] += histogram.get('requests', 0)
+            totals['xiq_retries'] += histogram.get('retries', 0)
+    totals['seconds'] = time.time() - started
+    report = {"started": started, "totals": totals, "tenants": [results[name] for name in names]}
+    try:
+        writeFileAtomic(tenants_report_file, json.dumps(report, indent=2))
+    except OSError as e:
+        logging.error(f"Unable to write the tenants report: {e}")
+    log_msg = (f"Synced {totals['tenants']} tenants in {totals['seconds']:.1f}s: {totals['success']} succeeded, {totals['failed']} failed, "
+               f"{totals['xiq_requests']} XIQ requests")
+    logging.info(log_msg)
+    print(log_msg)
 
 
 if __name__ == '__main__':
-	main()
+    parser = argparse.ArgumentParser(description="Sync Active Directory users to ExtremeCloud IQ PPSK users")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--daemon', action='store_true', help="keep running and sync every sync_interval seconds")
+    mode.add_argument('--plan', metavar='FILE', help="write the changes a sync would make to FILE without making them")
+    mode.add_argument('--apply', metavar='FILE', help="apply a plan written by --plan, resuming where a previous apply stopped")
+    mode.add_argument('--tenants', metavar='FILE', help="sync every tenant of a JSON tenants file in parallel worker processes")
+    args = parser.parse_args()
+    globals().update(loadADTuning(AD_tuning_file))
+    if args.daemon:
+        runDaemon()
+    elif args.tenants:
+        runTenants(args.tenants)
+    elif args.plan:
+        runOnce(lambda: writePlan(args.plan))
+    elif args.apply:
+        runOnce(lambda: applyPlan(args.apply))
+    else:
+        runOnce()